@@ -8,6 +8,17 @@ const CART_URL = process.env.REACT_APP_CART_URL || 'http://localhost:8002';
 const ORDER_URL = process.env.REACT_APP_ORDER_URL || 'http://localhost:8003';
 const PAYMENT_URL = process.env.REACT_APP_PAYMENT_URL || 'http://localhost:8004';
 
+// Apply a pushed change to the row with the given id. Rows not loaded yet are
+// only added when the change carries the complete row.
+const applyChange = (rows, id, changes, { prepend = false } = {}) => {
+  if (!changes) return rows;
+  if (rows.some(row => row.id === id)) {
+    return rows.map(row => (row.id === id ? { ...row, ...changes } : row));
+  }
+  if (changes.id !== id) return rows;
+  return prepend ? [changes, ...rows] : [...rows, changes];
+};
+
 function App() {
   const [activeTab, setActiveTab] = useState('dashboard');
   const [products, setProducts] = useState([]);
@@ -22,10 +33,56 @@ function App() {
   useEffect(() => {
     localStorage.setItem('userId', userId);
     fetchData();
-    const interval = setInterval(fetchData, 5000);
-    return () => clearInterval(interval);
   }, [userId]);
 
+  // Catalog and order push changes as server-sent events, so everything is
+  // loaded once and then kept current from deltas instead of polling.
+  // EventSource reconnects on its own and resumes from the last event it saw.
+  useEffect(() => {
+    const productFeed = new EventSource(`${CATALOG_URL}/products/stream`);
+    const onProductChange = (event) => {
+      const { product_id, changes } = JSON.parse(event.data);
+      setProducts(prev => applyChange(prev, product_id, changes));
+      if (changes && (changes.price !== undefined || changes.name !== undefined)) {
+        setCart(prev => {
+          if (!prev || !prev.items || !prev.items.some(item => item.product_id === product_id)) return prev;
+          const items = prev.items.map(item => (item.product_id === product_id ? {
+            ...item,
+            product_name: changes.name ?? item.product_name,
+            product_price: changes.price ?? item.product_price
+          } : item));
+          const total = items.reduce((sum, item) => sum + (item.product_price || 0) * item.quantity, 0);
+          return { ...prev, items, total };
+        });
+      }
+    };
+    productFeed.addEventListener('product_created', onProductChange);
+    productFeed.addEventListener('product_updated', onProductChange);
+    productFeed.addEventListener('product_deleted', (event) => {
+      const { product_id } = JSON.parse(event.data);
+      setProducts(prev => prev.filter(product => product.id !== product_id));
+    });
+    // Too much changed to apply piecemeal; reload
+    productFeed.addEventListener('products_imported', fetchProducts);
+    productFeed.addEventListener('reset', fetchProducts);
+
+    const orderFeed = new EventSource(`${ORDER_URL}/orders/stream`);
+    const onOrderChange = (event) => {
+      const { order_id, changes } = JSON.parse(event.data);
+      setOrders(prev => applyChange(prev, order_id, changes, { prepend: true }));
+      setSelectedOrder(prev => (prev && prev.id === order_id && changes ? { ...prev, ...changes } : prev));
+    };
+    orderFeed.addEventListener('order_created', onOrderChange);
+    orderFeed.addEventListener('order_status_updated', onOrderChange);
+    orderFeed.addEventListener('order_paid', onOrderChange);
+    orderFeed.addEventListener('reset', fetchOrders);
+
+    return () => {
+      productFeed.close();
+      orderFeed.close();
+    };
+  }, []);
+
   const fetchData = async () => {
     try {
       await Promise.all([
@@ -68,13 +125,15 @@ function App() {
     }
   };
 
+  // Cart changes go through PATCH, which answers with the updated cart, so no refetch is needed
+  const patchCart = async (operations) => {
+    const response = await axios.patch(`${CART_URL}/cart/${userId}`, { operations });
+    setCart(response.data);
+  };
+
   const addToCart = async (productId, quantity = 1) => {
     try {
-      await axios.post(`${CART_URL}/cart/${userId}/items`, {
-        product_id: productId,
-        quantity: quantity
-      });
-      fetchCart();
+      await patchCart([{ op: 'add', product_id: productId, quantity }]);
       alert('Item added to cart!');
     } catch (err) {
       alert('Failed to add item to cart: ' + (err.response?.data?.detail || err.message));
@@ -83,8 +142,7 @@ function App() {
 
   const removeFromCart = async (productId) => {
     try {
-      await axios.delete(`${CART_URL}/cart/${userId}/items/${productId}`);
-      fetchCart();
+      await patchCart([{ op: 'remove', product_id: productId }]);
     } catch (err) {
       alert('Failed to remove item from cart');
     }
@@ -96,10 +154,7 @@ function App() {
       return;
     }
     try {
-      await axios.put(`${CART_URL}/cart/${userId}/items/${productId}`, null, {
-        params: { quantity }
-      });
-      fetchCart();
+      await patchCart([{ op: 'set', product_id: productId, quantity }]);
     } catch (err) {
       alert('Failed to update cart');
     }
@@ -114,8 +169,8 @@ function App() {
       const response = await axios.post(`${ORDER_URL}/orders`, {
         user_id: userId
       });
-      fetchOrders();
-      fetchCart();
+      // The order arrives over the order feed; the service empties the cart in the background
+      setCart({ ...cart, items: [], total: 0 });
       alert(`Order created! Order ID: ${response.data.id}`);
     } catch (err) {
       alert('Failed to create order: ' + (err.response?.data?.detail || err.message));
@@ -125,7 +180,6 @@ function App() {
   const processPayment = async (orderId) => {
     try {
       await axios.post(`${ORDER_URL}/orders/${orderId}/payment`);
-      fetchOrders();
       alert('Payment processed!');
     } catch (err) {
       alert('Failed to process payment: ' + (err.response?.data?.detail || err.message));
@@ -143,7 +197,6 @@ function App() {
         category: newProduct.category
       });
       setNewProduct({ name: '', description: '', price: '', stock: '', category: '' });
-      fetchProducts();
       alert('Product created!');
     } catch (err) {
       alert('Failed to create product: ' + (err.response?.data?.detail || err.message));
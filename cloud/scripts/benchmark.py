@@ -0,0 +1,430 @@
+"""Load test for the checkout flow.
+
+Starts catalog, cart, order and payment with the in-memory event broker in
+place of Kafka, seeds the catalog, then runs each scenario for a fixed time at
+a fixed concurrency. It prints throughput and latency percentiles per
+endpoint as JSON:
+
+    python scripts/benchmark.py --concurrency 32 --duration 20 --output baseline.json
+    python scripts/benchmark.py --baseline baseline.json
+
+Scenarios:
+    browse       GET /products and GET /products/{product_id}
+    add_to_cart  POST /cart/{user_id}/items
+    get_cart     GET /cart/{user_id} for carts of --cart-items items
+    checkout     fill a cart, then POST /orders
+    pay          fill a cart, POST /orders, then POST /orders/{order_id}/payment
+
+Modes:
+    subprocess   one uvicorn process per service, as deployed (default)
+    inprocess    all four apps on one event loop in this process
+    external     services that are already running, e.g. port-forwarded
+                 (CATALOG_SERVICE_URL, CART_SERVICE_URL, ORDER_SERVICE_URL,
+                 PAYMENT_SERVICE_URL; defaults to localhost:8001-8004)
+
+Every scenario is measured on its own after --warmup seconds that are not
+recorded. Each worker uses its own users, so runs do not contend on carts.
+"""
+import argparse
+import asyncio
+import contextlib
+import importlib.util
+import json
+import math
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+from collections import defaultdict
+from typing import Awaitable, Callable, Dict, List, Optional
+
+import httpx
+
+SERVICES_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "services")
+SERVICES = ["catalog", "cart", "order", "payment"]
+SCENARIOS = ["browse", "add_to_cart", "get_cart", "checkout", "pay"]
+PERCENTILES = (50, 95, 99)
+
+BENCHMARK_CATEGORY = "Benchmark"
+BENCHMARK_STOCK = 10_000_000
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_values:
+        return 0.0
+    rank = max(math.ceil(pct / 100 * len(sorted_values)), 1)
+    return sorted_values[rank - 1]
+
+
+class Recorder:
+    """Latencies and errors per endpoint for one scenario."""
+
+    def __init__(self):
+        self.latencies: Dict[str, List[float]] = defaultdict(list)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.recording = False
+
+    async def call(self, client: httpx.AsyncClient, endpoint: str, method: str, url: str, **kwargs) -> httpx.Response:
+        started = time.perf_counter()
+        try:
+            response = await client.request(method, url, **kwargs)
+        except httpx.HTTPError:
+            if self.recording:
+                self.errors[endpoint] += 1
+            raise
+        elapsed = time.perf_counter() - started
+        if self.recording:
+            self.latencies[endpoint].append(elapsed * 1000)
+            if response.status_code >= 400:
+                self.errors[endpoint] += 1
+        return response
+
+    def report(self, elapsed: float) -> dict:
+        endpoints = {}
+        for endpoint in sorted(set(self.latencies) | set(self.errors)):
+            values = sorted(self.latencies[endpoint])
+            endpoints[endpoint] = {
+                "requests": len(values),
+                "errors": self.errors[endpoint],
+                "rps": round(len(values) / elapsed, 1) if elapsed else 0.0,
+                "mean_ms": round(sum(values) / len(values), 2) if values else 0.0,
+                **{f"p{pct}_ms": round(percentile(values, pct), 2) for pct in PERCENTILES},
+                "max_ms": round(values[-1], 2) if values else 0.0,
+            }
+        return endpoints
+
+
+class Benchmark:
+    def __init__(self, urls: Dict[str, str], args: argparse.Namespace):
+        self.urls = urls
+        self.args = args
+        self.product_ids: List[int] = []
+        self.client: Optional[httpx.AsyncClient] = None
+
+    async def seed(self):
+        """Bulk-import products with enough stock that checkouts never run out."""
+        lines = "".join(
+            json.dumps({
+                "name": f"Benchmark product {index}",
+                "description": "Seeded by scripts/benchmark.py",
+                "price": round(random.uniform(1, 500), 2),
+                "stock": BENCHMARK_STOCK,
+                "category": BENCHMARK_CATEGORY,
+            }) + "\n"
+            for index in range(self.args.products)
+        )
+        response = await self.client.post(
+            f"{self.urls['catalog']}/products/bulk",
+            content=lines.encode("utf-8"),
+            headers={"Content-Type": "application/x-ndjson"},
+            timeout=120,
+        )
+        response.raise_for_status()
+        async with self.client.stream("GET", f"{self.urls['catalog']}/products/export", timeout=120) as export:
+            async for line in export.aiter_lines():
+                if line:
+                    product = json.loads(line)
+                    if product["category"] == BENCHMARK_CATEGORY and product["stock"] > 0:
+                        self.product_ids.append(product["id"])
+        if not self.product_ids:
+            raise RuntimeError("Catalog has no benchmark products after seeding")
+
+    # Scenarios: each returns a coroutine function run in a loop by every worker
+    async def fill_cart(self, recorder: Recorder, user_id: str, items: int):
+        for product_id in random.sample(self.product_ids, min(items, len(self.product_ids))):
+            await recorder.call(
+                self.client, "POST /cart/{user_id}/items", "POST", f"{self.urls['cart']}/cart/{user_id}/items",
+                json={"product_id": product_id, "quantity": 1},
+            )
+
+    async def checkout(self, recorder: Recorder, user_id: str) -> Optional[int]:
+        await self.fill_cart(recorder, user_id, self.args.checkout_items)
+        response = await recorder.call(
+            self.client, "POST /orders", "POST", f"{self.urls['order']}/orders", json={"user_id": user_id}
+        )
+        return response.json()["id"] if response.status_code == 200 else None
+
+    async def scenario(self, name: str, recorder: Recorder, worker: int) -> Callable[[int], Awaitable[None]]:
+        run_id = self.args.run_id
+        if name == "browse":
+            async def step(iteration: int):
+                await recorder.call(
+                    self.client, "GET /products", "GET", f"{self.urls['catalog']}/products",
+                    params={"limit": self.args.page_size},
+                )
+                product_id = random.choice(self.product_ids)
+                await recorder.call(
+                    self.client, "GET /products/{product_id}", "GET", f"{self.urls['catalog']}/products/{product_id}"
+                )
+            return step
+
+        if name == "add_to_cart":
+            async def step(iteration: int):
+                # A fresh cart every so often keeps cart sizes realistic
+                user_id = f"bench-{run_id}-add-{worker}-{iteration // 20}"
+                await recorder.call(
+                    self.client, "POST /cart/{user_id}/items", "POST", f"{self.urls['cart']}/cart/{user_id}/items",
+                    json={"product_id": random.choice(self.product_ids), "quantity": 1},
+                )
+            return step
+
+        if name == "get_cart":
+            user_id = f"bench-{run_id}-get-{worker}"
+            # Filled before recording starts, so only the reads are measured
+            await self.fill_cart(recorder, user_id, self.args.cart_items)
+
+            async def step(iteration: int):
+                await recorder.call(self.client, "GET /cart/{user_id}", "GET", f"{self.urls['cart']}/cart/{user_id}")
+            return step
+
+        if name == "checkout":
+            async def step(iteration: int):
+                await self.checkout(recorder, f"bench-{run_id}-checkout-{worker}-{iteration}")
+            return step
+
+        if name == "pay":
+            async def step(iteration: int):
+                order_id = await self.checkout(recorder, f"bench-{run_id}-pay-{worker}-{iteration}")
+                if order_id is not None:
+                    await recorder.call(
+                        self.client, "POST /orders/{order_id}/payment", "POST",
+                        f"{self.urls['order']}/orders/{order_id}/payment",
+                    )
+            return step
+
+        raise ValueError(f"Unknown scenario {name}")
+
+    async def run_scenario(self, name: str) -> dict:
+        recorder = Recorder()
+        steps = [await self.scenario(name, recorder, worker) for worker in range(self.args.concurrency)]
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.args.warmup + self.args.duration
+
+        async def worker(step: Callable[[int], Awaitable[None]]):
+            iteration = 0
+            while loop.time() < deadline:
+                try:
+                    await step(iteration)
+                except (httpx.HTTPError, ValueError, KeyError):
+                    # Already counted as an error by the recorder where it applies
+                    pass
+                iteration += 1
+
+        async def start_recording():
+            await asyncio.sleep(self.args.warmup)
+            recorder.recording = True
+            return loop.time()
+
+        recording = asyncio.create_task(start_recording())
+        await asyncio.gather(*(worker(step) for step in steps))
+        elapsed = loop.time() - await recording
+        return recorder.report(elapsed)
+
+    async def run(self) -> dict:
+        limits = httpx.Limits(max_connections=self.args.concurrency * 2, max_keepalive_connections=self.args.concurrency * 2)
+        async with httpx.AsyncClient(limits=limits, timeout=self.args.timeout) as client:
+            self.client = client
+            await self.seed()
+            results = {}
+            for name in self.args.scenarios:
+                results[name] = await self.run_scenario(name)
+                print(f"{name}: done", file=sys.stderr)
+        return results
+
+
+# Service startup
+async def wait_healthy(urls: Dict[str, str], timeout: float = 30.0):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        for service, url in urls.items():
+            while True:
+                try:
+                    if (await client.get(f"{url}/health", timeout=1.0)).status_code == 200:
+                        break
+                except httpx.HTTPError:
+                    pass
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"{service} did not become healthy at {url}")
+                await asyncio.sleep(0.2)
+
+
+def service_env(ports: Dict[str, int]) -> Dict[str, str]:
+    return {
+        "EVENT_BROKER": "memory",
+        "PYTHONPATH": os.path.abspath(SERVICES_DIR),
+        "CATALOG_SERVICE_URL": f"http://127.0.0.1:{ports['catalog']}",
+        "CART_SERVICE_URL": f"http://127.0.0.1:{ports['cart']}",
+        "PAYMENT_SERVICE_URL": f"http://127.0.0.1:{ports['payment']}",
+    }
+
+
+def start_subprocesses(workdir: str, ports: Dict[str, int]) -> List[subprocess.Popen]:
+    processes = []
+    for service in SERVICES:
+        env = {**os.environ, **service_env(ports), "DB_PATH": os.path.join(workdir, f"{service}.db")}
+        log = open(os.path.join(workdir, f"{service}.log"), "w")
+        processes.append(subprocess.Popen(
+            [
+                sys.executable, "-m", "uvicorn", "main:app",
+                "--host", "127.0.0.1", "--port", str(ports[service]),
+                "--log-level", "warning", "--no-access-log",
+            ],
+            cwd=os.path.join(SERVICES_DIR, service),
+            env=env,
+            stdout=log,
+            stderr=subprocess.STDOUT,
+        ))
+    return processes
+
+
+def stop_subprocesses(processes: List[subprocess.Popen]):
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        try:
+            process.wait(timeout=10)
+        except subprocess.TimeoutExpired:
+            process.kill()
+
+
+def load_app(service: str, workdir: str):
+    """Import a service's main.py under a unique module name.
+
+    Configuration is read at import time, so DB_PATH is set just before.
+    """
+    os.environ["DB_PATH"] = os.path.join(workdir, f"{service}.db")
+    spec = importlib.util.spec_from_file_location(
+        f"{service}_main", os.path.join(SERVICES_DIR, service, "main.py")
+    )
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.app
+
+
+async def start_in_process(workdir: str, ports: Dict[str, int]) -> list:
+    import uvicorn
+
+    os.environ.update(service_env(ports))
+    sys.path.insert(0, os.path.abspath(SERVICES_DIR))
+    servers = []
+    for service in SERVICES:
+        config = uvicorn.Config(
+            load_app(service, workdir), host="127.0.0.1", port=ports[service],
+            log_level="warning", access_log=False,
+        )
+        server = uvicorn.Server(config)
+        # Signal handling belongs to this script, not to each embedded server
+        server.install_signal_handlers = lambda: None
+        servers.append((server, asyncio.create_task(server.serve())))
+    return servers
+
+
+async def stop_in_process(servers: list):
+    for server, _ in servers:
+        server.should_exit = True
+    await asyncio.gather(*(task for _, task in servers), return_exceptions=True)
+
+
+def compare(results: dict, baseline: dict) -> dict:
+    """Percentage change against a previous run for the headline numbers."""
+    changes = {}
+    for scenario, endpoints in results.items():
+        for endpoint, current in endpoints.items():
+            previous = baseline.get("results", {}).get(scenario, {}).get(endpoint)
+            if not previous:
+                continue
+            changes.setdefault(scenario, {})[endpoint] = {
+                metric: round((current[metric] - previous[metric]) / previous[metric] * 100, 1)
+                for metric in ("rps", "p50_ms", "p95_ms", "p99_ms")
+                if previous.get(metric)
+            }
+    return changes
+
+
+async def main(args: argparse.Namespace) -> dict:
+    ports = {service: args.base_port + index for index, service in enumerate(SERVICES)}
+    processes: List[subprocess.Popen] = []
+    servers: list = []
+    with tempfile.TemporaryDirectory(prefix="benchmark-") as workdir:
+        if args.mode == "external":
+            urls = {
+                service: os.getenv(f"{service.upper()}_SERVICE_URL", f"http://localhost:{8001 + index}").rstrip("/")
+                for index, service in enumerate(SERVICES)
+            }
+        else:
+            urls = {service: f"http://127.0.0.1:{port}" for service, port in ports.items()}
+            if args.mode == "subprocess":
+                processes = start_subprocesses(workdir, ports)
+            else:
+                servers = await start_in_process(workdir, ports)
+        try:
+            await wait_healthy(urls)
+            results = await Benchmark(urls, args).run()
+        finally:
+            if processes:
+                stop_subprocesses(processes)
+            if servers:
+                await stop_in_process(servers)
+
+    report = {
+        "started_at": time.strftime("%Y-%m-%dT%H:%M:%S%z", time.localtime(args.started)),
+        "mode": args.mode,
+        "config": {
+            "concurrency": args.concurrency,
+            "duration_s": args.duration,
+            "warmup_s": args.warmup,
+            "products": args.products,
+            "cart_items": args.cart_items,
+            "checkout_items": args.checkout_items,
+        },
+        "python": platform.python_version(),
+        "results": results,
+    }
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as baseline_file:
+            report["change_pct"] = compare(results, json.load(baseline_file))
+    return report
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Benchmark the checkout flow across all four services.")
+    parser.add_argument("--mode", choices=["subprocess", "inprocess", "external"], default="subprocess")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS),
+                        help=f"comma-separated subset of {','.join(SCENARIOS)}")
+    parser.add_argument("--concurrency", type=int, default=16, help="concurrent workers per scenario")
+    parser.add_argument("--duration", type=float, default=10.0, help="recorded seconds per scenario")
+    parser.add_argument("--warmup", type=float, default=2.0, help="unrecorded seconds before each scenario")
+    parser.add_argument("--products", type=int, default=1000, help="products to seed")
+    parser.add_argument("--cart-items", type=int, default=20, help="items in each get_cart cart")
+    parser.add_argument("--checkout-items", type=int, default=3, help="items in each checked-out cart")
+    parser.add_argument("--page-size", type=int, default=20, help="limit for GET /products")
+    parser.add_argument("--timeout", type=float, default=30.0, help="per-request timeout in seconds")
+    parser.add_argument("--base-port", type=int, default=18001, help="first of four ports for started services")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--baseline", help="earlier report to compare against")
+    args = parser.parse_args(argv)
+    args.scenarios = [name.strip() for name in args.scenarios.split(",") if name.strip()]
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    args.started = time.time()
+    # Keeps users distinct across runs against the same (external) databases
+    args.run_id = f"{int(args.started):x}"
+    return args
+
+
+if __name__ == "__main__":
+    arguments = parse_args()
+    # In-process services print to stdout; keep it for the report
+    with contextlib.redirect_stdout(sys.stderr):
+        report = asyncio.run(main(arguments))
+    output = json.dumps(report, indent=2)
+    if arguments.output:
+        with open(arguments.output, "w", encoding="utf-8") as output_file:
+            output_file.write(output + "\n")
+    else:
+        print(output)
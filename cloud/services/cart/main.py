@@ -1,10 +1,23 @@
 from fastapi import FastAPI, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from typing import List, Optional
-import sqlite3
+from typing import Dict, List, Optional, Tuple
+from enum import Enum
+import asyncio
+import json
 import os
-import httpx
+import time
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from datetime import datetime
+from common.cache import TTLCache
+from common.db import Database
+from common.events import EventSubscriber
+from common.http import ServiceClient, Upstream
+from common.loop import LoopLagMonitor
+from common.metrics import instrument
+from common.migrations import Migration, migrate
+from common.tracing import trace_requests
 
 app = FastAPI(title="Cart Service", version="1.0.0")
 
@@ -17,14 +30,89 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Request, database, outbound call and event metrics on /metrics
+instrument(app, "cart")
+
+# Spans for every request, continuing the caller's W3C traceparent
+trace_requests(app, "cart")
+
 # Configuration
 DB_PATH = os.getenv("DB_PATH", "cart.db")
 CATALOG_SERVICE_URL = os.getenv("CATALOG_SERVICE_URL", "http://catalog-service:8001")
+CATALOG_TIMEOUT = float(os.getenv("CATALOG_TIMEOUT", "2.0"))
+KAFKA_BOOTSTRAP_SERVERS = os.getenv("KAFKA_BOOTSTRAP_SERVERS", "kafka:9092")
+PRODUCT_CACHE_SIZE = int(os.getenv("PRODUCT_CACHE_SIZE", "10000"))
+PRODUCT_CACHE_TTL = float(os.getenv("PRODUCT_CACHE_TTL", "30"))
+# "sqlite" keeps carts in DB_PATH; "memory" keeps them in process and snapshots to CART_SNAPSHOT_PATH
+CART_STORE = os.getenv("CART_STORE", "sqlite")
+CART_TTL_HOURS = float(os.getenv("CART_TTL_HOURS", "72"))
+CART_SNAPSHOT_PATH = os.getenv("CART_SNAPSHOT_PATH", "cart-snapshot.json")
+CART_SNAPSHOT_INTERVAL = float(os.getenv("CART_SNAPSHOT_INTERVAL", "30"))
+CART_MAX_OPERATIONS = int(os.getenv("CART_MAX_OPERATIONS", "500"))
+PRICED_CART_CACHE_SIZE = int(os.getenv("PRICED_CART_CACHE_SIZE", "10000"))
+# Priced carts hold product prices, so they go no staler than the product cache by default
+PRICED_CART_TTL = float(os.getenv("PRICED_CART_TTL", str(PRODUCT_CACHE_TTL)))
+
+db = Database(DB_PATH)
+
+# Pooled client for calls to catalog, opened on startup and closed on shutdown
+http = ServiceClient(Upstream("catalog", CATALOG_SERVICE_URL, timeout=CATALOG_TIMEOUT))
+loop_lag = LoopLagMonitor()
+
+# Product records rarely change; catalog's product events invalidate entries and
+# the TTL bounds staleness if an event is missed
+product_cache = TTLCache(maxsize=PRODUCT_CACHE_SIZE, ttl=PRODUCT_CACHE_TTL)
+
+class ProductVersions:
+    """Version of each recently changed product, bounded to ``maxsize`` entries.
+
+    Versions come from one counter, so a product's new version is always
+    higher than any line was stamped with. Products without an entry report
+    the highest version evicted so far: a line stamped before its product's
+    entry was evicted then reads as stale and is re-priced, never missed.
+    """
+
+    def __init__(self, maxsize: int):
+        self.maxsize = maxsize
+        self._versions: "OrderedDict[int, int]" = OrderedDict()
+        self._counter = 0
+        self._floor = 0
+
+    def get(self, product_id: int) -> int:
+        return self._versions.get(product_id, self._floor)
+
+    def bump(self, product_id: int):
+        self._counter += 1
+        self._versions[product_id] = self._counter
+        self._versions.move_to_end(product_id)
+        while len(self._versions) > self.maxsize:
+            _, evicted = self._versions.popitem(last=False)
+            self._floor = max(self._floor, evicted)
+
+# Catalog version of each product as far as pricing is concerned. Priced carts
+# stamp every line with it, so only lines whose product changed are re-priced.
+product_versions = ProductVersions(maxsize=PRODUCT_CACHE_SIZE)
+PRICED_FIELDS = {"name", "price"}
+
+def product_version(product_id: int) -> int:
+    return product_versions.get(product_id)
+
+def on_product_event(event: dict):
+    data = event.get("data", {})
+    product_id = data.get("product_id")
+    if product_id is not None:
+        product_cache.invalidate(product_id)
+        changes = data.get("changes")
+        # Stock moves with every checkout; only a name or price change re-prices carts
+        if changes is None or PRICED_FIELDS & set(changes):
+            product_versions.bump(product_id)
+
+product_events = EventSubscriber("product-events", KAFKA_BOOTSTRAP_SERVERS, on_product_event, service="cart")
 
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("""
+# Schema migrations, applied in order at startup
+MIGRATIONS = [
+    # UNIQUE(user_id, product_id) also serves the per-user lookups
+    Migration(1, "create_cart_items", ["""
         CREATE TABLE IF NOT EXISTS cart_items (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id TEXT NOT NULL,
@@ -33,13 +121,272 @@ def init_db():
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             UNIQUE(user_id, product_id)
         )
-    """)
+    """]),
+]
+
+# Cart storage. Both backends return items as dicts with the cart_items columns.
+class SQLiteCartStore:
+    def __init__(self, db: Database):
+        self.db = db
+
+    async def start(self):
+        migrate(self.db, MIGRATIONS)
+
+    async def stop(self):
+        pass
+
+    async def get_items(self, user_id: str) -> List[dict]:
+        rows = await self.db.fetchall("SELECT * FROM cart_items WHERE user_id = ?", (user_id,))
+        return [dict(row) for row in rows]
+
+    async def add_item(self, user_id: str, product_id: int, quantity: int) -> dict:
+        return await self.db.run(upsert_cart_item, user_id, product_id, quantity)
+
+    async def apply(self, user_id: str, operations: List[Tuple[str, int, int]]) -> List[dict]:
+        return await self.db.run(apply_cart_operations, user_id, operations)
+
+    async def set_quantity(self, user_id: str, product_id: int, quantity: int) -> bool:
+        cursor = await self.db.execute(
+            "UPDATE cart_items SET quantity = ? WHERE user_id = ? AND product_id = ?",
+            (quantity, user_id, product_id)
+        )
+        return cursor.rowcount > 0
+
+    async def remove_item(self, user_id: str, product_id: int) -> bool:
+        cursor = await self.db.execute(
+            "DELETE FROM cart_items WHERE user_id = ? AND product_id = ?",
+            (user_id, product_id)
+        )
+        return cursor.rowcount > 0
+
+    async def clear(self, user_id: str):
+        await self.db.execute("DELETE FROM cart_items WHERE user_id = ?", (user_id,))
+
+    def stats(self) -> dict:
+        return {"backend": "sqlite"}
+
+# One statement adds to (or sets) an existing line or creates it, and hands back the row
+ADD_ITEM_SQL = """
+    INSERT INTO cart_items (user_id, product_id, quantity) VALUES (?, ?, ?)
+    ON CONFLICT(user_id, product_id) DO UPDATE SET quantity = quantity + excluded.quantity
+    RETURNING *
+"""
+SET_ITEM_SQL = """
+    INSERT INTO cart_items (user_id, product_id, quantity) VALUES (?, ?, ?)
+    ON CONFLICT(user_id, product_id) DO UPDATE SET quantity = excluded.quantity
+    RETURNING *
+"""
+
+def upsert_cart_item(conn, user_id: str, product_id: int, quantity: int) -> dict:
+    row = conn.execute(ADD_ITEM_SQL, (user_id, product_id, quantity)).fetchone()
+    conn.commit()
+    return dict(row)
+
+def apply_cart_operations(conn, user_id: str, operations: List[Tuple[str, int, int]]) -> List[dict]:
+    # In order, in one transaction; the connection rolls back if any statement fails
+    for op, product_id, quantity in operations:
+        if op == CartOp.REMOVE:
+            conn.execute("DELETE FROM cart_items WHERE user_id = ? AND product_id = ?", (user_id, product_id))
+        else:
+            conn.execute(ADD_ITEM_SQL if op == CartOp.ADD else SET_ITEM_SQL, (user_id, product_id, quantity)).fetchone()
+    rows = conn.execute("SELECT * FROM cart_items WHERE user_id = ?", (user_id,)).fetchall()
     conn.commit()
-    conn.close()
+    return [dict(row) for row in rows]
+
+class MemoryCartStore:
+    """Carts held in process, for a single replica.
+
+    Operations never await, so each one is atomic on the event loop. Carts
+    untouched for ``ttl`` seconds are dropped as abandoned. Every
+    ``snapshot_interval`` seconds a changed set of carts is written to
+    ``snapshot_path`` (one write however many changes came in between) and it
+    is loaded back on start, so a restart keeps carts without replaying writes.
+    """
+
+    def __init__(self, snapshot_path: str, ttl: float, snapshot_interval: float):
+        self.snapshot_path = snapshot_path
+        self.ttl = ttl
+        self.snapshot_interval = snapshot_interval
+        # user_id -> {"touched": epoch seconds, "items": {product_id: item}}
+        self._carts: Dict[str, dict] = {}
+        self._next_id = 1
+        self._dirty = False
+        self._task: Optional[asyncio.Task] = None
+        self.expired = 0
+        self.snapshots = 0
+        self.last_snapshot_ms = 0.0
+
+    async def start(self):
+        await asyncio.to_thread(self._load)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.snapshot()
+
+    def _load(self):
+        try:
+            with open(self.snapshot_path, encoding="utf-8") as snapshot:
+                state = json.load(snapshot)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print(f"Cart snapshot unreadable, starting empty: {e}")
+            return
+        self._next_id = state.get("next_id", 1)
+        self._carts = {
+            user_id: {
+                "touched": cart["touched"],
+                "items": {item["product_id"]: item for item in cart["items"]},
+            }
+            for user_id, cart in state.get("carts", {}).items()
+        }
+        self.expire()
+
+    def _write(self, payload: str):
+        # Write aside and rename, so a crash mid-write leaves the previous snapshot intact
+        temporary_path = f"{self.snapshot_path}.tmp"
+        with open(temporary_path, "w", encoding="utf-8") as snapshot:
+            snapshot.write(payload)
+        os.replace(temporary_path, self.snapshot_path)
+
+    async def snapshot(self):
+        if not self._dirty:
+            return
+        started = time.perf_counter()
+        # Serialize on the loop so the state is consistent; only the file I/O moves off it
+        payload = json.dumps({
+            "next_id": self._next_id,
+            "carts": {
+                user_id: {"touched": cart["touched"], "items": list(cart["items"].values())}
+                for user_id, cart in self._carts.items()
+            },
+        })
+        self._dirty = False
+        try:
+            await asyncio.to_thread(self._write, payload)
+        except OSError as e:
+            self._dirty = True
+            print(f"Cart snapshot error (non-critical): {e}")
+            return
+        self.snapshots += 1
+        self.last_snapshot_ms = (time.perf_counter() - started) * 1000
+
+    def expire(self):
+        cutoff = time.time() - self.ttl
+        abandoned = [user_id for user_id, cart in self._carts.items() if cart["touched"] < cutoff]
+        for user_id in abandoned:
+            del self._carts[user_id]
+        if abandoned:
+            self.expired += len(abandoned)
+            self._dirty = True
+
+    async def _run(self):
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            self.expire()
+            await self.snapshot()
+
+    def _cart(self, user_id: str, create: bool = False) -> Optional[dict]:
+        cart = self._carts.get(user_id)
+        if cart is not None and cart["touched"] < time.time() - self.ttl:
+            del self._carts[user_id]
+            self.expired += 1
+            self._dirty = True
+            cart = None
+        if cart is None and create:
+            cart = self._carts[user_id] = {"touched": time.time(), "items": {}}
+        return cart
+
+    def _touch(self, cart: dict):
+        cart["touched"] = time.time()
+        self._dirty = True
+
+    async def get_items(self, user_id: str) -> List[dict]:
+        cart = self._cart(user_id)
+        return [dict(item) for item in cart["items"].values()] if cart else []
+
+    async def add_item(self, user_id: str, product_id: int, quantity: int) -> dict:
+        cart = self._cart(user_id, create=True)
+        item = cart["items"].get(product_id)
+        if item is None:
+            item = cart["items"][product_id] = {
+                "id": self._next_id,
+                "user_id": user_id,
+                "product_id": product_id,
+                "quantity": 0,
+                # Same format as SQLite's CURRENT_TIMESTAMP
+                "created_at": datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S"),
+            }
+            self._next_id += 1
+        item["quantity"] += quantity
+        self._touch(cart)
+        return dict(item)
+
+    async def apply(self, user_id: str, operations: List[Tuple[str, int, int]]) -> List[dict]:
+        # None of these calls suspend, so other requests see all of the changes or none
+        for op, product_id, quantity in operations:
+            if op == CartOp.REMOVE:
+                await self.remove_item(user_id, product_id)
+            elif op == CartOp.ADD:
+                await self.add_item(user_id, product_id, quantity)
+            elif not await self.set_quantity(user_id, product_id, quantity):
+                await self.add_item(user_id, product_id, quantity)
+        return await self.get_items(user_id)
+
+    async def set_quantity(self, user_id: str, product_id: int, quantity: int) -> bool:
+        cart = self._cart(user_id)
+        if cart is None or product_id not in cart["items"]:
+            return False
+        cart["items"][product_id]["quantity"] = quantity
+        self._touch(cart)
+        return True
+
+    async def remove_item(self, user_id: str, product_id: int) -> bool:
+        cart = self._cart(user_id)
+        if cart is None or cart["items"].pop(product_id, None) is None:
+            return False
+        self._touch(cart)
+        return True
+
+    async def clear(self, user_id: str):
+        if self._carts.pop(user_id, None) is not None:
+            self._dirty = True
+
+    def stats(self) -> dict:
+        return {
+            "backend": "memory",
+            "carts": len(self._carts),
+            "expired": self.expired,
+            "snapshots": self.snapshots,
+            "last_snapshot_ms": round(self.last_snapshot_ms, 2),
+        }
+
+if CART_STORE == "memory":
+    cart_store = MemoryCartStore(CART_SNAPSHOT_PATH, CART_TTL_HOURS * 3600, CART_SNAPSHOT_INTERVAL)
+else:
+    cart_store = SQLiteCartStore(db)
 
 @app.on_event("startup")
-def startup():
-    init_db()
+async def startup():
+    await cart_store.start()
+    await http.start()
+    await product_events.start()
+    loop_lag.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await loop_lag.stop()
+    await product_events.stop()
+    await http.close()
+    await cart_store.stop()
+    db.close()
 
 # Models
 class CartItemCreate(BaseModel):
@@ -63,47 +410,234 @@ class CartResponse(BaseModel):
     items: List[CartItem]
     total: float
 
-# Helper function to get product info
-async def get_product_info(product_id: int):
+class CartOp(str, Enum):
+    ADD = "add"
+    SET = "set"
+    REMOVE = "remove"
+
+class CartOperation(BaseModel):
+    op: CartOp
+    product_id: int
+    # add: defaults to 1; set: required; remove: ignored
+    quantity: Optional[int] = None
+
+class CartPatch(BaseModel):
+    operations: List[CartOperation]
+
+# Helper functions to get product info. A product catalog does not return is
+# None; a failed lookup raises 503, so it is never cached or priced as missing.
+CATALOG_UNAVAILABLE = "Catalog service unavailable"
+
+async def fetch_product(product_id: int):
     try:
-        async with httpx.AsyncClient() as client:
-            response = await client.get(f"{CATALOG_SERVICE_URL}/products/{product_id}")
-            if response.status_code == 200:
-                return response.json()
+        response = await http.get("catalog", f"/products/{product_id}")
     except Exception as e:
         print(f"Error fetching product: {e}")
-    return None
+        raise HTTPException(status_code=503, detail=CATALOG_UNAVAILABLE)
+    if response.status_code == 404:
+        return None
+    if response.status_code != 200:
+        print(f"Error fetching product {product_id}: catalog returned {response.status_code}")
+        raise HTTPException(status_code=503, detail=CATALOG_UNAVAILABLE)
+    return response.json()
+
+async def fetch_products(product_ids: List[int]) -> dict:
+    ids = ",".join(str(product_id) for product_id in product_ids)
+    try:
+        response = await http.get("catalog", "/products", params={"ids": ids})
+    except Exception as e:
+        print(f"Error fetching products: {e}")
+        raise HTTPException(status_code=503, detail=CATALOG_UNAVAILABLE)
+    if response.status_code != 200:
+        print(f"Error fetching products: catalog returned {response.status_code}")
+        raise HTTPException(status_code=503, detail=CATALOG_UNAVAILABLE)
+    return {product["id"]: product for product in response.json()}
+
+async def get_product_info(product_id: int):
+    return await product_cache.get_or_load(product_id, lambda: fetch_product(product_id))
+
+async def get_products_info(product_ids: List[int]) -> dict:
+    """Resolve many products keyed by id; cache misses go to catalog in one batch call."""
+    if not product_ids:
+        return {}
+    return await product_cache.get_many(product_ids, fetch_products)
+
+class PricedCart:
+    """A user's cart lines with names and unit prices, and the total.
+
+    ``versions`` holds the product version each line was priced at; lines
+    whose product has moved on since are re-priced on the next read.
+    """
+
+    def __init__(self, user_id: str):
+        self.user_id = user_id
+        self.items: Dict[int, dict] = {}
+        self.versions: Dict[int, int] = {}
+        self.total = 0.0
+
+    def put(self, row: dict, product_info: Optional[dict], version: int):
+        item = dict(row)
+        if product_info:
+            item["product_name"] = product_info.get("name")
+            item["product_price"] = product_info.get("price")
+        else:
+            # Gone from catalog: the line stays but is no longer priced or totalled
+            item["product_name"] = None
+            item["product_price"] = None
+        self.items[item["product_id"]] = item
+        self.versions[item["product_id"]] = version
+
+    def set_quantity(self, product_id: int, quantity: int):
+        if product_id in self.items:
+            self.items[product_id]["quantity"] = quantity
+
+    def remove(self, product_id: int):
+        self.items.pop(product_id, None)
+        self.versions.pop(product_id, None)
+
+    def retotal(self):
+        self.total = sum((item.get("product_price") or 0) * item["quantity"] for item in self.items.values())
+
+    def stale(self) -> List[int]:
+        return [product_id for product_id, version in self.versions.items() if version != product_version(product_id)]
+
+    async def price(self, rows: List[dict]):
+        # Versions are read before the lookup, so a change landing mid-lookup is caught next time
+        versions = {row["product_id"]: product_version(row["product_id"]) for row in rows}
+        products = await get_products_info(list(versions))
+        for row in rows:
+            self.put(row, products.get(row["product_id"]), versions[row["product_id"]])
+        self.retotal()
+
+    async def reprice(self, product_ids: List[int]):
+        versions = {product_id: product_version(product_id) for product_id in product_ids}
+        products = await get_products_info(product_ids)
+        for product_id, version in versions.items():
+            item = self.items.get(product_id)
+            if item is not None:
+                self.put(item, products.get(product_id), version)
+        self.retotal()
+
+    def response(self) -> CartResponse:
+        return CartResponse(
+            user_id=self.user_id,
+            items=[CartItem(**item) for item in self.items.values()],
+            total=self.total
+        )
+
+# Priced carts are built from the store once and then kept current by every
+# mutation, so reads and checkout pricing go to catalog only for re-pricing.
+# The TTL bounds staleness if a product event is missed.
+priced_carts = TTLCache(maxsize=PRICED_CART_CACHE_SIZE, ttl=PRICED_CART_TTL)
+cart_locks: Dict[str, list] = {}
+
+@asynccontextmanager
+async def cart_lock(user_id: str):
+    """Serialize mutations of one cart, so the priced cart sees them in store order."""
+    entry = cart_locks.get(user_id)
+    if entry is None:
+        # [lock, holders and waiters]
+        entry = cart_locks[user_id] = [asyncio.Lock(), 0]
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            yield
+    finally:
+        entry[1] -= 1
+        if entry[1] == 0:
+            del cart_locks[user_id]
+
+async def load_priced_cart(user_id: str) -> PricedCart:
+    cart = PricedCart(user_id)
+    await cart.price(await cart_store.get_items(user_id))
+    return cart
+
+async def get_priced_cart(user_id: str) -> PricedCart:
+    cart = await priced_carts.get_or_load(user_id, lambda: load_priced_cart(user_id))
+    stale = cart.stale()
+    if stale:
+        await cart.reprice(stale)
+    return cart
+
+def update_priced_cart(user_id: str, change):
+    """Apply ``change`` to the cached priced cart; without one, stop any in-flight build from caching stale lines."""
+    cart = priced_carts.get(user_id)
+    if cart is None:
+        priced_carts.invalidate(user_id)
+        return
+    change(cart)
+    cart.retotal()
+
+def replace_priced_cart(user_id: str, cart: PricedCart):
+    # Invalidate first so a build that started before this change is not cached over it
+    priced_carts.invalidate(user_id)
+    priced_carts.set(user_id, cart)
 
 # Routes
 @app.get("/health")
 def health():
-    return {"status": "healthy", "service": "cart"}
+    return {
+        "status": "healthy",
+        "service": "cart",
+        **loop_lag.snapshot(),
+        "product_cache": product_cache.stats(),
+        "priced_carts": priced_carts.stats(),
+        "cart_store": cart_store.stats(),
+    }
 
 @app.get("/cart/{user_id}", response_model=CartResponse)
 async def get_cart(user_id: str):
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM cart_items WHERE user_id = ?", (user_id,))
-    rows = cursor.fetchall()
-    conn.close()
-    
-    items = []
-    total = 0.0
-    
-    for row in rows:
-        product_info = await get_product_info(row["product_id"])
-        item = dict(row)
-        if product_info:
-            item["product_name"] = product_info.get("name")
-            item["product_price"] = product_info.get("price")
-            total += product_info.get("price", 0) * row["quantity"]
-        items.append(CartItem(**item))
-    
-    return CartResponse(user_id=user_id, items=items, total=total)
+    return (await get_priced_cart(user_id)).response()
+
+@app.patch("/cart/{user_id}", response_model=CartResponse)
+async def update_cart(user_id: str, patch: CartPatch):
+    """Apply add/set/remove operations in order, all or nothing.
+
+    Products being added or set are checked with one catalog lookup for the
+    whole batch; removing an item that is not in the cart is a no-op.
+    """
+    if not patch.operations:
+        raise HTTPException(status_code=400, detail="No operations")
+    if len(patch.operations) > CART_MAX_OPERATIONS:
+        raise HTTPException(status_code=400, detail=f"At most {CART_MAX_OPERATIONS} operations per request")
+
+    operations = []
+    for operation in patch.operations:
+        quantity = operation.quantity
+        if operation.op == CartOp.ADD and quantity is None:
+            quantity = 1
+        if operation.op != CartOp.REMOVE and (quantity is None or quantity <= 0):
+            raise HTTPException(
+                status_code=400,
+                detail=f"Quantity must be positive for {operation.op.value} of product {operation.product_id}"
+            )
+        operations.append((operation.op, operation.product_id, quantity or 0))
+
+    wanted = list(dict.fromkeys(product_id for op, product_id, _ in operations if op != CartOp.REMOVE))
+    products = await get_products_info(wanted)
+    missing = [product_id for product_id in wanted if product_id not in products]
+    if missing:
+        raise HTTPException(status_code=404, detail=f"Products not found: {', '.join(map(str, missing))}")
+    for op, product_id, quantity in operations:
+        if op != CartOp.REMOVE and products[product_id].get("stock", 0) < quantity:
+            raise HTTPException(status_code=400, detail=f"Insufficient stock for product {product_id}")
+
+    async with cart_lock(user_id):
+        rows = await cart_store.apply(user_id, operations)
+        # Prices come from the product cache the validation above just filled
+        cart = PricedCart(user_id)
+        try:
+            await cart.price(rows)
+        except HTTPException:
+            # The store has the change; drop the cached cart so the next read rebuilds it
+            priced_carts.invalidate(user_id)
+            raise
+        replace_priced_cart(user_id, cart)
+    return cart.response()
 
 @app.post("/cart/{user_id}/items", response_model=CartItem)
 async def add_item(user_id: str, item: CartItemCreate):
+    version = product_version(item.product_id)
     # Verify product exists
     product_info = await get_product_info(item.product_id)
     if not product_info:
@@ -113,61 +647,22 @@ async def add_item(user_id: str, item: CartItemCreate):
     if product_info.get("stock", 0) < item.quantity:
         raise HTTPException(status_code=400, detail="Insufficient stock")
     
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
-    # Check if item already exists
-    cursor.execute(
-        "SELECT id, quantity FROM cart_items WHERE user_id = ? AND product_id = ?",
-        (user_id, item.product_id)
-    )
-    existing = cursor.fetchone()
-    
-    if existing:
-        # Update quantity
-        new_quantity = existing[1] + item.quantity
-        cursor.execute(
-            "UPDATE cart_items SET quantity = ? WHERE id = ?",
-            (new_quantity, existing[0])
-        )
-        item_id = existing[0]
-    else:
-        # Insert new item
-        cursor.execute(
-            "INSERT INTO cart_items (user_id, product_id, quantity) VALUES (?, ?, ?)",
-            (user_id, item.product_id, item.quantity)
-        )
-        item_id = cursor.lastrowid
-    
-    conn.commit()
-    conn.close()
+    async with cart_lock(user_id):
+        row = await cart_store.add_item(user_id, item.product_id, item.quantity)
+        update_priced_cart(user_id, lambda cart: cart.put(row, product_info, version))
     
     # Return cart item with product info
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM cart_items WHERE id = ?", (item_id,))
-    row = dict(cursor.fetchone())
-    conn.close()
-    
     row["product_name"] = product_info.get("name")
     row["product_price"] = product_info.get("price")
     
     return CartItem(**row)
 
 @app.delete("/cart/{user_id}/items/{product_id}")
-def remove_item(user_id: str, product_id: int):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        "DELETE FROM cart_items WHERE user_id = ? AND product_id = ?",
-        (user_id, product_id)
-    )
-    if cursor.rowcount == 0:
-        conn.close()
-        raise HTTPException(status_code=404, detail="Item not found in cart")
-    conn.commit()
-    conn.close()
+async def remove_item(user_id: str, product_id: int):
+    async with cart_lock(user_id):
+        if not await cart_store.remove_item(user_id, product_id):
+            raise HTTPException(status_code=404, detail="Item not found in cart")
+        update_priced_cart(user_id, lambda cart: cart.remove(product_id))
     return {"message": "Item removed from cart"}
 
 @app.put("/cart/{user_id}/items/{product_id}")
@@ -175,26 +670,18 @@ async def update_item_quantity(user_id: str, product_id: int, quantity: int):
     if quantity <= 0:
         raise HTTPException(status_code=400, detail="Quantity must be positive")
     
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        "UPDATE cart_items SET quantity = ? WHERE user_id = ? AND product_id = ?",
-        (quantity, user_id, product_id)
-    )
-    if cursor.rowcount == 0:
-        conn.close()
-        raise HTTPException(status_code=404, detail="Item not found in cart")
-    conn.commit()
-    conn.close()
+    async with cart_lock(user_id):
+        if not await cart_store.set_quantity(user_id, product_id, quantity):
+            raise HTTPException(status_code=404, detail="Item not found in cart")
+        update_priced_cart(user_id, lambda cart: cart.set_quantity(product_id, quantity))
     return {"message": "Item quantity updated"}
 
 @app.delete("/cart/{user_id}")
-def clear_cart(user_id: str):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM cart_items WHERE user_id = ?", (user_id,))
-    conn.commit()
-    conn.close()
+async def clear_cart(user_id: str):
+    async with cart_lock(user_id):
+        await cart_store.clear(user_id)
+        # Checkout clears the cart; the next read is answered without the store
+        replace_priced_cart(user_id, PricedCart(user_id))
     return {"message": "Cart cleared"}
 
 if __name__ == "__main__":
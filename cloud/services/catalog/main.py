@@ -1,10 +1,20 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Header, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
-from pydantic import BaseModel
-from typing import List, Optional
-import sqlite3
+from fastapi.responses import StreamingResponse
+from pydantic import BaseModel, ValidationError
+from typing import AsyncIterator, List, Optional
+import csv
+import json
 import os
+import re
 from datetime import datetime
+from common.db import Database
+from common.events import EventPublisher, EventSubscriber, producer_factory
+from common.feed import ChangeFeed
+from common.metrics import instrument
+from common.migrations import Migration, add_column, migrate
+from common.pagination import NEXT_CURSOR_HEADER, decode_cursor, next_cursor
+from common.tracing import trace_requests
 
 app = FastAPI(title="Catalog Service", version="1.0.0")
 
@@ -15,15 +25,35 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[NEXT_CURSOR_HEADER],
 )
 
+# Request, database, outbound call and event metrics on /metrics
+instrument(app, "catalog")
+
+# Spans for every request, continuing the caller's W3C traceparent
+trace_requests(app, "catalog")
+
 # Database setup
 DB_PATH = os.getenv("DB_PATH", "catalog.db")
+KAFKA_BOOTSTRAP_SERVERS = os.getenv("KAFKA_BOOTSTRAP_SERVERS", "kafka:9092")
+PRODUCTS_MAX_AGE = int(os.getenv("PRODUCTS_MAX_AGE", "0"))
+BULK_CHUNK_SIZE = int(os.getenv("BULK_CHUNK_SIZE", "1000"))
+BULK_MAX_ERRORS = int(os.getenv("BULK_MAX_ERRORS", "1000"))
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+db = Database(DB_PATH)
 
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("""
+# Product change events let other services invalidate their caches
+events = EventPublisher(producer_factory(KAFKA_BOOTSTRAP_SERVERS))
+
+# Dashboards follow product changes over server-sent events instead of polling;
+# the feed reads the topic so every replica streams every change
+feed = ChangeFeed()
+product_feed = EventSubscriber("product-events", KAFKA_BOOTSTRAP_SERVERS, feed.publish_event, service="catalog")
+
+# Schema migrations, applied in order at startup
+MIGRATIONS = [
+    Migration(1, "create_products", ["""
         CREATE TABLE IF NOT EXISTS products (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             name TEXT NOT NULL,
@@ -33,31 +63,133 @@ def init_db():
             category TEXT,
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
-    """)
-    conn.commit()
-    conn.close()
+    """]),
+    # Version counter bumped by triggers on every products write; backs the ETags
+    Migration(2, "products_version_counter", [
+        """
+        CREATE TABLE IF NOT EXISTS table_versions (
+            name TEXT PRIMARY KEY,
+            version INTEGER NOT NULL DEFAULT 0
+        )
+        """,
+        "INSERT OR IGNORE INTO table_versions (name, version) VALUES ('products', 0)",
+    ] + [
+        f"""
+        CREATE TRIGGER IF NOT EXISTS products_version_{operation.lower()}
+        AFTER {operation} ON products
+        BEGIN
+            UPDATE table_versions SET version = version + 1 WHERE name = 'products';
+        END
+        """
+        for operation in ("INSERT", "UPDATE", "DELETE")
+    ]),
+    # Backs keyset pagination over (created_at, id)
+    Migration(3, "products_created_at_index", [
+        "CREATE INDEX IF NOT EXISTS idx_products_created_at_id ON products(created_at, id)",
+    ]),
+    Migration(4, "products_category_index", [
+        "CREATE INDEX IF NOT EXISTS idx_products_category ON products(category)",
+    ]),
+    # One row per reserved line; released rows stay behind as a record
+    Migration(5, "create_stock_reservations", [
+        """
+        CREATE TABLE IF NOT EXISTS stock_reservations (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            product_id INTEGER NOT NULL,
+            quantity INTEGER NOT NULL,
+            status TEXT NOT NULL DEFAULT 'reserved',
+            created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+            released_at TIMESTAMP
+        )
+        """,
+    ]),
+    # Full-text index over name and description. It reads content from products
+    # and is kept in step by triggers; stock and price updates do not touch it.
+    Migration(6, "products_search_index", [
+        """
+        CREATE VIRTUAL TABLE IF NOT EXISTS products_fts USING fts5(
+            name, description,
+            content='products', content_rowid='id',
+            tokenize='unicode61 remove_diacritics 2'
+        )
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS products_fts_insert AFTER INSERT ON products
+        BEGIN
+            INSERT INTO products_fts (rowid, name, description) VALUES (new.id, new.name, new.description);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS products_fts_delete AFTER DELETE ON products
+        BEGIN
+            INSERT INTO products_fts (products_fts, rowid, name, description)
+            VALUES ('delete', old.id, old.name, old.description);
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS products_fts_update AFTER UPDATE OF name, description ON products
+        BEGIN
+            INSERT INTO products_fts (products_fts, rowid, name, description)
+            VALUES ('delete', old.id, old.name, old.description);
+            INSERT INTO products_fts (rowid, name, description) VALUES (new.id, new.name, new.description);
+        END
+        """,
+        # Index whatever was in products before the triggers existed
+        "INSERT INTO products_fts (products_fts) VALUES ('rebuild')",
+        "CREATE INDEX IF NOT EXISTS idx_products_price ON products(price)",
+    ]),
+    # Caller-chosen key for each reservation: a retried reserve replays the
+    # original rows, and a caller that lost the response can release by key
+    Migration(7, "stock_reservations_key", [
+        add_column("stock_reservations", "reservation_key", "TEXT"),
+        "CREATE INDEX IF NOT EXISTS idx_stock_reservations_key ON stock_reservations(reservation_key)",
+    ]),
+]
+
+def init_db():
+    migrate(db, MIGRATIONS)
 
 # Initialize database on startup
 @app.on_event("startup")
-def startup():
+async def startup():
     init_db()
     # Add sample products
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("SELECT COUNT(*) FROM products")
-    if cursor.fetchone()[0] == 0:
-        sample_products = [
-            ("Laptop", "High-performance laptop", 999.99, 10, "Electronics"),
-            ("Mouse", "Wireless mouse", 29.99, 50, "Electronics"),
-            ("Keyboard", "Mechanical keyboard", 79.99, 30, "Electronics"),
-            ("Monitor", "27-inch 4K monitor", 399.99, 15, "Electronics"),
-        ]
-        cursor.executemany(
-            "INSERT INTO products (name, description, price, stock, category) VALUES (?, ?, ?, ?, ?)",
-            sample_products
-        )
-        conn.commit()
-    conn.close()
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT COUNT(*) FROM products")
+        if cursor.fetchone()[0] == 0:
+            sample_products = [
+                ("Laptop", "High-performance laptop", 999.99, 10, "Electronics"),
+                ("Mouse", "Wireless mouse", 29.99, 50, "Electronics"),
+                ("Keyboard", "Mechanical keyboard", 79.99, 30, "Electronics"),
+                ("Monitor", "27-inch 4K monitor", 399.99, 15, "Electronics"),
+            ]
+            cursor.executemany(
+                "INSERT INTO products (name, description, price, stock, category) VALUES (?, ?, ?, ?, ?)",
+                sample_products
+            )
+            conn.commit()
+    await events.start()
+    await product_feed.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await product_feed.stop()
+    await events.stop()
+    db.close()
+
+# Helper function to publish product changes to Kafka
+def publish_product_event(event_type: str, product_id: int, changes: Optional[dict] = None):
+    data = {"product_id": product_id}
+    if changes:
+        # Changed fields (or the whole row) so subscribers can apply the delta without a read
+        data["changes"] = changes
+    event = {
+        "event_type": event_type,
+        "timestamp": datetime.utcnow().isoformat(),
+        "data": data
+    }
+    events.publish("product-events", event, key=str(product_id))
 
 # Models
 class ProductCreate(BaseModel):
@@ -86,52 +218,475 @@ class Product(BaseModel):
     class Config:
         from_attributes = True
 
+class ReservationLine(BaseModel):
+    product_id: int
+    quantity: int
+
+class ReservationRequest(BaseModel):
+    items: List[ReservationLine]
+    reservation_key: Optional[str] = None
+
+class Reservation(BaseModel):
+    reservation_id: int
+    product_id: int
+    quantity: int
+
+class ReservationResult(BaseModel):
+    reservations: List[Reservation]
+
+class ReleaseRequest(BaseModel):
+    reservation_ids: List[int] = []
+    reservation_keys: List[str] = []
+
+class CategoryFacet(BaseModel):
+    category: Optional[str]
+    count: int
+
+class SearchResult(BaseModel):
+    total: int
+    products: List[Product]
+    facets: List[CategoryFacet]
+
+class BulkRowError(BaseModel):
+    line: int
+    error: str
+
+class BulkResult(BaseModel):
+    inserted: int
+    failed: int
+    errors: List[BulkRowError]
+
 # Routes
 @app.get("/health")
 def health():
-    return {"status": "healthy", "service": "catalog"}
+    return {"status": "healthy", "service": "catalog", "feed": feed.stats()}
+
+# SQLite caps the number of bound parameters per statement
+MAX_BATCH_IDS = 500
+
+def parse_ids(ids: str) -> List[int]:
+    try:
+        parsed = [int(part) for part in ids.split(",") if part.strip()]
+    except ValueError:
+        raise HTTPException(status_code=400, detail="ids must be a comma-separated list of integers")
+    # Drop duplicates but keep the caller's order
+    return list(dict.fromkeys(parsed))
+
+# HTTP caching: ETags derive from the products version, so an unchanged table
+# answers 304 without querying or serializing any rows
+def products_version(conn) -> int:
+    return conn.execute("SELECT version FROM table_versions WHERE name = 'products'").fetchone()[0]
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == "*":
+        return True
+    # If-None-Match uses weak comparison, so ignore any W/ prefix
+    candidates = [tag.strip().removeprefix("W/") for tag in if_none_match.split(",")]
+    return etag in candidates
+
+def cache_headers(etag: str) -> dict:
+    return {"ETag": etag, "Cache-Control": f"public, max-age={PRODUCTS_MAX_AGE}, must-revalidate"}
 
 @app.get("/products", response_model=List[Product])
-def get_products(skip: int = 0, limit: int = 100):
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM products LIMIT ? OFFSET ?", (limit, skip))
-    products = [dict(row) for row in cursor.fetchall()]
-    conn.close()
+def get_products(
+    response: Response,
+    skip: int = 0,
+    limit: int = 100,
+    ids: Optional[str] = None,
+    after: Optional[str] = None,
+    if_none_match: Optional[str] = Header(None),
+):
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        # Read the version before the rows so the ETag is never newer than the body
+        etag = f'"products-{products_version(conn)}"'
+        if etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers=cache_headers(etag))
+        response.headers.update(cache_headers(etag))
+        if ids is not None:
+            # Batch lookup: GET /products?ids=1,2,3 resolves many products in one query
+            product_ids = parse_ids(ids)
+            products = []
+            for start in range(0, len(product_ids), MAX_BATCH_IDS):
+                chunk = product_ids[start:start + MAX_BATCH_IDS]
+                placeholders = ", ".join("?" for _ in chunk)
+                cursor.execute(f"SELECT * FROM products WHERE id IN ({placeholders})", chunk)
+                products.extend(dict(row) for row in cursor.fetchall())
+            return products
+        if after is not None:
+            # Keyset pagination: seek past the cursor instead of scanning skipped rows
+            try:
+                created_at, product_id = decode_cursor(after)
+            except ValueError as e:
+                raise HTTPException(status_code=400, detail=str(e))
+            cursor.execute(
+                "SELECT * FROM products WHERE (created_at, id) > (?, ?) ORDER BY created_at, id LIMIT ?",
+                (created_at, product_id, limit)
+            )
+        else:
+            cursor.execute("SELECT * FROM products ORDER BY created_at, id LIMIT ? OFFSET ?", (limit, skip))
+        products = [dict(row) for row in cursor.fetchall()]
+    cursor_value = next_cursor(products, limit)
+    if cursor_value:
+        response.headers[NEXT_CURSOR_HEADER] = cursor_value
     return products
 
-@app.get("/products/{product_id}", response_model=Product)
-def get_product(product_id: int):
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM products WHERE id = ?", (product_id,))
-    product = cursor.fetchone()
-    conn.close()
+def load_product(product_id: int) -> dict:
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM products WHERE id = ?", (product_id,))
+        product = cursor.fetchone()
     if not product:
         raise HTTPException(status_code=404, detail="Product not found")
     return dict(product)
 
-@app.post("/products", response_model=Product)
-def create_product(product: ProductCreate):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
+# Bulk import/export: the request body and the export are streamed line by
+# line, so neither side ever holds the whole catalog in memory
+PRODUCT_COLUMNS = ("name", "description", "price", "stock", "category")
+
+def bulk_format(content_type: Optional[str]) -> str:
+    media_type = (content_type or "").split(";")[0].strip().lower()
+    if media_type in ("text/csv", "application/csv"):
+        return "csv"
+    if media_type in ("", "application/x-ndjson", "application/ndjson", "application/jsonl"):
+        return "ndjson"
+    raise HTTPException(status_code=415, detail="Send NDJSON (application/x-ndjson) or CSV (text/csv)")
+
+async def stream_lines(request: Request) -> AsyncIterator[bytes]:
+    buffer = b""
+    async for chunk in request.stream():
+        buffer += chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield line
+    if buffer:
+        yield buffer
+
+def row_error(error: Exception) -> str:
+    if isinstance(error, ValidationError):
+        return "; ".join(
+            f"{'.'.join(str(part) for part in detail['loc']) or 'row'}: {detail['msg']}"
+            for detail in error.errors()
+        )
+    return str(error)
+
+def insert_products(conn, rows: list):
+    conn.executemany(
         "INSERT INTO products (name, description, price, stock, category) VALUES (?, ?, ?, ?, ?)",
-        (product.name, product.description, product.price, product.stock, product.category)
+        rows
     )
-    product_id = cursor.lastrowid
     conn.commit()
-    conn.close()
+
+@app.post("/products/bulk", response_model=BulkResult)
+async def bulk_create_products(request: Request):
+    """Import NDJSON objects or CSV rows (with a header line) of product fields.
+
+    Valid rows are inserted in chunks of BULK_CHUNK_SIZE, each chunk in one
+    transaction; invalid rows are skipped and reported by line number.
+    """
+    body_format = bulk_format(request.headers.get("content-type"))
+    header = None
+    pending = []
+    inserted = 0
+    failed = 0
+    errors = []
+    line_number = 0
+    async for raw_line in stream_lines(request):
+        line_number += 1
+        try:
+            line = raw_line.decode("utf-8").strip()
+            if line_number == 1:
+                line = line.lstrip("\ufeff")
+            if not line:
+                continue
+            if body_format == "csv":
+                values = next(csv.reader([line]))
+                if header is None:
+                    header = [column.strip().lower() for column in values]
+                    if "name" not in header or "price" not in header:
+                        raise HTTPException(status_code=400, detail="CSV header must include name and price")
+                    continue
+                data = {column: value for column, value in zip(header, values) if value != ""}
+            else:
+                data = json.loads(line)
+            product = ProductCreate.model_validate(data)
+        except (ValueError, csv.Error) as e:
+            # Covers bad UTF-8, malformed JSON/CSV and validation errors
+            failed += 1
+            if len(errors) < BULK_MAX_ERRORS:
+                errors.append({"line": line_number, "error": row_error(e)})
+            continue
+        pending.append(tuple(getattr(product, column) for column in PRODUCT_COLUMNS))
+        if len(pending) >= BULK_CHUNK_SIZE:
+            await db.run(insert_products, pending)
+            inserted += len(pending)
+            pending = []
+    if pending:
+        await db.run(insert_products, pending)
+        inserted += len(pending)
+    if inserted:
+        # One event for the whole import; subscribers reload rather than apply every row
+        events.publish("product-events", {
+            "event_type": "products_imported",
+            "timestamp": datetime.utcnow().isoformat(),
+            "data": {"count": inserted}
+        })
+    return {"inserted": inserted, "failed": failed, "errors": errors}
+
+def export_page(conn, after_id: int) -> List[dict]:
+    rows = conn.execute(
+        "SELECT * FROM products WHERE id > ? ORDER BY id LIMIT ?", (after_id, EXPORT_BATCH_SIZE)
+    ).fetchall()
+    return [dict(row) for row in rows]
+
+async def iter_products_ndjson() -> AsyncIterator[str]:
+    # Each page is its own short read seeking past the last id, so a slow client
+    # holds no pooled connection or read transaction between pages
+    after_id = 0
+    while True:
+        rows = await db.run(export_page, after_id)
+        if not rows:
+            break
+        yield "".join(json.dumps(row) + "\n" for row in rows)
+        after_id = rows[-1]["id"]
+
+@app.get("/products/export")
+def export_products():
+    return StreamingResponse(iter_products_ndjson(), media_type="application/x-ndjson")
+
+@app.get("/products/stream")
+async def stream_products(request: Request, last_event_id: Optional[str] = Header(None)):
+    """Server-sent events: product_created, product_updated, product_deleted, products_imported."""
+    return feed.response(request, last_event_id)
+
+# Search: FTS5 ranks the text matches, category and price filter them, and the
+# facet counts ignore the category filter so every category stays selectable
+MAX_SEARCH_LIMIT = 100
+
+def match_expression(q: str) -> Optional[str]:
+    """Turn free text into a safe FTS5 query: all words must match, the last as a prefix."""
+    words = re.findall(r"\w+", q)
+    if not words:
+        return None
+    return " ".join(f'"{word}"' for word in words) + "*"
+
+def search_products_query(
+    conn,
+    match: Optional[str],
+    category: Optional[str],
+    min_price: Optional[float],
+    max_price: Optional[float],
+    limit: int,
+    offset: int,
+) -> dict:
+    if match:
+        source = "products_fts JOIN products p ON p.id = products_fts.rowid"
+        # bm25 is lower-is-better; name hits count ten times a description hit
+        order_by = "bm25(products_fts, 10.0, 1.0), p.id"
+        conditions = ["products_fts MATCH ?"]
+        params = [match]
+    else:
+        source = "products p"
+        order_by = "p.id"
+        conditions = []
+        params = []
+    if min_price is not None:
+        conditions.append("p.price >= ?")
+        params.append(min_price)
+    if max_price is not None:
+        conditions.append("p.price <= ?")
+        params.append(max_price)
+
+    facet_where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    facets = [
+        dict(row) for row in conn.execute(
+            f"SELECT p.category AS category, COUNT(*) AS count FROM {source} {facet_where} "
+            "GROUP BY p.category ORDER BY count DESC, p.category",
+            params
+        )
+    ]
+
+    if category is not None:
+        conditions.append("p.category = ?")
+        params.append(category)
+        total = next((facet["count"] for facet in facets if facet["category"] == category), 0)
+    else:
+        total = sum(facet["count"] for facet in facets)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+    products = [
+        dict(row) for row in conn.execute(
+            f"SELECT p.* FROM {source} {where} ORDER BY {order_by} LIMIT ? OFFSET ?",
+            params + [limit, offset]
+        )
+    ]
+    return {"total": total, "products": products, "facets": facets}
+
+@app.get("/products/search", response_model=SearchResult)
+def search_products(
+    response: Response,
+    q: Optional[str] = None,
+    category: Optional[str] = None,
+    min_price: Optional[float] = None,
+    max_price: Optional[float] = None,
+    limit: int = 20,
+    offset: int = 0,
+    if_none_match: Optional[str] = Header(None),
+):
+    if not 1 <= limit <= MAX_SEARCH_LIMIT:
+        raise HTTPException(status_code=400, detail=f"limit must be between 1 and {MAX_SEARCH_LIMIT}")
+    with db.connection() as conn:
+        # Same version counter as the listings, so unchanged results revalidate for free
+        etag = f'"search-{products_version(conn)}"'
+        if etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers=cache_headers(etag))
+        result = search_products_query(
+            conn, match_expression(q or ""), category, min_price, max_price, limit, max(offset, 0)
+        )
+    response.headers.update(cache_headers(etag))
+    return result
+
+# Stock reservations: each line is a conditional decrement, so concurrent
+# checkouts can never take stock below zero and no read-modify-write is needed
+@app.post("/products/reserve", response_model=ReservationResult)
+def reserve_stock(request: ReservationRequest):
+    if not request.items:
+        raise HTTPException(status_code=400, detail="No items to reserve")
+    if len(request.items) > MAX_BATCH_IDS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_IDS} items per reservation")
+    if any(line.quantity <= 0 for line in request.items):
+        raise HTTPException(status_code=400, detail="Quantities must be positive")
+
+    reservations = []
+    stock = {}
+    # Any failing line raises, which rolls back every decrement made so far
+    with db.connection() as conn:
+        if request.reservation_key:
+            # Hold the write lock from the lookup on, so a concurrent retry cannot reserve twice
+            conn.execute("BEGIN IMMEDIATE")
+            existing = conn.execute(
+                "SELECT id AS reservation_id, product_id, quantity, status FROM stock_reservations "
+                "WHERE reservation_key = ? ORDER BY id",
+                (request.reservation_key,)
+            ).fetchall()
+            if any(row["status"] == "released" for row in existing):
+                raise HTTPException(status_code=409, detail="Reservation already released")
+            if existing:
+                return {"reservations": [dict(row) for row in existing]}
+        for line in request.items:
+            updated = conn.execute(
+                "UPDATE products SET stock = stock - ? WHERE id = ? AND stock >= ? RETURNING stock",
+                (line.quantity, line.product_id, line.quantity)
+            ).fetchone()
+            if updated is None:
+                exists = conn.execute("SELECT 1 FROM products WHERE id = ?", (line.product_id,)).fetchone()
+                if not exists:
+                    raise HTTPException(status_code=404, detail=f"Product {line.product_id} not found")
+                raise HTTPException(status_code=409, detail=f"Insufficient stock for product {line.product_id}")
+            stock[line.product_id] = updated["stock"]
+            cursor = conn.execute(
+                "INSERT INTO stock_reservations (product_id, quantity, reservation_key) VALUES (?, ?, ?)",
+                (line.product_id, line.quantity, request.reservation_key)
+            )
+            reservations.append({
+                "reservation_id": cursor.lastrowid,
+                "product_id": line.product_id,
+                "quantity": line.quantity
+            })
+        conn.commit()
+
+    for product_id, remaining in stock.items():
+        publish_product_event("product_updated", product_id, {"stock": remaining})
+    return {"reservations": reservations}
+
+@app.post("/products/release", response_model=ReservationResult)
+def release_stock(request: ReleaseRequest):
+    """Return reserved stock, by reservation ID or by reservation key.
+
+    Already released or unknown IDs and keys are skipped, so retries are safe.
+    """
+    reservation_ids = list(dict.fromkeys(request.reservation_ids))
+    reservation_keys = list(dict.fromkeys(request.reservation_keys))
+    if len(reservation_ids) + len(reservation_keys) > MAX_BATCH_IDS:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_BATCH_IDS} reservations per release")
+
+    released = []
+    stock = {}
+    with db.connection() as conn:
+        if reservation_keys:
+            # A key with no rows yet may belong to a reserve still in flight; leave a
+            # released marker so that reserve is refused instead of taking the stock
+            placeholders = ", ".join("?" for _ in reservation_keys)
+            known = {
+                row["reservation_key"] for row in conn.execute(
+                    "SELECT DISTINCT reservation_key FROM stock_reservations "
+                    f"WHERE reservation_key IN ({placeholders})",
+                    reservation_keys
+                )
+            }
+            conn.executemany(
+                "INSERT INTO stock_reservations (product_id, quantity, status, released_at, reservation_key) "
+                "VALUES (0, 0, 'released', CURRENT_TIMESTAMP, ?)",
+                [(key,) for key in reservation_keys if key not in known]
+            )
+        if reservation_ids or reservation_keys:
+            id_placeholders = ", ".join("?" for _ in reservation_ids)
+            key_placeholders = ", ".join("?" for _ in reservation_keys)
+            released = [
+                dict(row) for row in conn.execute(
+                    f"""
+                    UPDATE stock_reservations
+                    SET status = 'released', released_at = CURRENT_TIMESTAMP
+                    WHERE (id IN ({id_placeholders}) OR reservation_key IN ({key_placeholders}))
+                    AND status = 'reserved'
+                    RETURNING id AS reservation_id, product_id, quantity
+                    """,
+                    reservation_ids + reservation_keys
+                ).fetchall()
+            ]
+            for row in released:
+                updated = conn.execute(
+                    "UPDATE products SET stock = stock + ? WHERE id = ? RETURNING stock",
+                    (row["quantity"], row["product_id"])
+                ).fetchone()
+                if updated is not None:
+                    stock[row["product_id"]] = updated["stock"]
+        conn.commit()
+
+    for product_id, remaining in stock.items():
+        publish_product_event("product_updated", product_id, {"stock": remaining})
+    return {"reservations": released}
+
+@app.get("/products/{product_id}", response_model=Product)
+def get_product(product_id: int, response: Response, if_none_match: Optional[str] = Header(None)):
+    with db.connection() as conn:
+        etag = f'"product-{product_id}-{products_version(conn)}"'
+        if etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers=cache_headers(etag))
+        product = conn.execute("SELECT * FROM products WHERE id = ?", (product_id,)).fetchone()
+    if not product:
+        raise HTTPException(status_code=404, detail="Product not found")
+    response.headers.update(cache_headers(etag))
+    return dict(product)
+
+@app.post("/products", response_model=Product)
+def create_product(product: ProductCreate):
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(
+            "INSERT INTO products (name, description, price, stock, category) VALUES (?, ?, ?, ?, ?)",
+            (product.name, product.description, product.price, product.stock, product.category)
+        )
+        product_id = cursor.lastrowid
+        conn.commit()
     
-    return get_product(product_id)
+    created = load_product(product_id)
+    publish_product_event("product_created", product_id, created)
+    return created
 
 @app.put("/products/{product_id}", response_model=Product)
 def update_product(product_id: int, product: ProductUpdate):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    
     # Build update query dynamically
     updates = []
     values = []
@@ -155,22 +710,26 @@ def update_product(product_id: int, product: ProductUpdate):
         raise HTTPException(status_code=400, detail="No fields to update")
     
     values.append(product_id)
-    cursor.execute(f"UPDATE products SET {', '.join(updates)} WHERE id = ?", values)
-    conn.commit()
-    conn.close()
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute(f"UPDATE products SET {', '.join(updates)} WHERE id = ?", values)
+        updated = cursor.rowcount
+        conn.commit()
     
-    return get_product(product_id)
+    changed = load_product(product_id)
+    if updated:
+        publish_product_event("product_updated", product_id, changed)
+    return changed
 
 @app.delete("/products/{product_id}")
 def delete_product(product_id: int):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("DELETE FROM products WHERE id = ?", (product_id,))
-    if cursor.rowcount == 0:
-        conn.close()
-        raise HTTPException(status_code=404, detail="Product not found")
-    conn.commit()
-    conn.close()
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("DELETE FROM products WHERE id = ?", (product_id,))
+        if cursor.rowcount == 0:
+            raise HTTPException(status_code=404, detail="Product not found")
+        conn.commit()
+    publish_product_event("product_deleted", product_id)
     return {"message": "Product deleted successfully"}
 
 if __name__ == "__main__":
@@ -0,0 +1 @@
+"""Shared building blocks for the e-commerce services."""
@@ -0,0 +1,128 @@
+"""Size-bounded LRU cache with per-entry TTL and single-flight loading.
+
+Concurrent misses for the same key share one in-flight load instead of each
+hitting the upstream. Invalidating a key while it is loading marks that load
+stale, so data read before the change is not written back.
+"""
+import asyncio
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable, Optional, Set
+
+
+class TTLCache:
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: "OrderedDict[Hashable, tuple]" = OrderedDict()
+        self._inflight: Dict[Hashable, asyncio.Future] = {}
+        # In-flight loads invalidated before they finished; their results are not cached
+        self._stale: Set[Hashable] = set()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        entry = self._entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        value, expires_at = entry
+        if expires_at < time.monotonic():
+            del self._entries[key]
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: Hashable, value: Any):
+        self._entries[key] = (value, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, key: Hashable):
+        self.invalidations += 1
+        self._entries.pop(key, None)
+        if key in self._inflight:
+            self._stale.add(key)
+
+    def clear(self):
+        self._stale.update(self._inflight)
+        self._entries.clear()
+
+    async def get_or_load(self, key: Hashable, load: Callable[[], Awaitable[Optional[Any]]]) -> Optional[Any]:
+        value = self.get(key)
+        if value is not None:
+            return value
+        if key in self._inflight:
+            return await asyncio.shield(self._inflight[key])
+
+        async def load_one(keys: list) -> Dict[Hashable, Any]:
+            return {key: await load()}
+
+        return (await self._load_keys([key], load_one))[key]
+
+    async def get_many(
+        self,
+        keys: Iterable[Hashable],
+        load_many: Callable[[list], Awaitable[Dict[Hashable, Any]]],
+    ) -> Dict[Hashable, Any]:
+        """Return cached values for ``keys``, loading every miss with one ``load_many`` call."""
+        found: Dict[Hashable, Any] = {}
+        waiting: Dict[Hashable, asyncio.Future] = {}
+        missing = []
+        for key in dict.fromkeys(keys):
+            value = self.get(key)
+            if value is not None:
+                found[key] = value
+            elif key in self._inflight:
+                waiting[key] = self._inflight[key]
+            else:
+                missing.append(key)
+        if missing:
+            found.update(await self._load_keys(missing, load_many))
+        for key, future in waiting.items():
+            found[key] = await asyncio.shield(future)
+        return {key: value for key, value in found.items() if value is not None}
+
+    async def _load_keys(self, keys: list, load_many: Callable) -> Dict[Hashable, Any]:
+        loop = asyncio.get_running_loop()
+        futures = {key: loop.create_future() for key in keys}
+        self._inflight.update(futures)
+        try:
+            loaded = await load_many(keys)
+        except asyncio.CancelledError:
+            for future in futures.values():
+                future.cancel()
+            raise
+        except Exception as e:
+            for future in futures.values():
+                future.set_exception(e)
+                # Mark retrieved so unawaited failures are not logged
+                future.exception()
+            raise
+        finally:
+            for key in keys:
+                self._inflight.pop(key, None)
+            stale = self._stale.intersection(keys)
+            self._stale.difference_update(keys)
+        results = {key: loaded.get(key) for key in keys}
+        for key, value in results.items():
+            if value is not None and key not in stale:
+                self.set(key, value)
+            futures[key].set_result(value)
+        return results
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._entries),
+            "maxsize": self.maxsize,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "invalidations": self.invalidations,
+        }
@@ -0,0 +1,160 @@
+"""Pooled SQLite access shared by every service.
+
+Connections are opened once, tuned for concurrent access (WAL journal,
+``synchronous=NORMAL``, memory-mapped reads, a busy timeout and a prepared
+statement cache) and then reused across requests instead of reconnecting in
+every handler.
+
+Async handlers go through ``Database.run`` (or the ``fetchone``/``fetchall``/
+``execute`` shortcuts), which hand the work to a bounded executor so a slow
+query never stalls the event loop.
+
+Every ``execute``/``executemany`` is timed into the
+``db_query_duration_seconds`` histogram, labelled by statement, and recorded
+as a span of the current trace.
+"""
+import asyncio
+import contextvars
+import os
+import queue
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Any, Callable, Iterator, List, Optional, TypeVar
+
+from common.metrics import DB_QUERY_DURATION, statement_label
+from common.tracing import record_span
+
+# Configuration
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "8"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "10"))
+DB_BUSY_TIMEOUT_MS = int(os.getenv("DB_BUSY_TIMEOUT_MS", "5000"))
+DB_MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", str(64 * 1024 * 1024)))
+DB_STATEMENT_CACHE_SIZE = int(os.getenv("DB_STATEMENT_CACHE_SIZE", "256"))
+
+T = TypeVar("T")
+
+
+def _record_statement(sql: str, elapsed: float):
+    statement = statement_label(sql)
+    DB_QUERY_DURATION.observe(elapsed, statement=statement)
+    record_span("db.query", "client", elapsed, {"db.system": "sqlite", "db.statement": statement})
+
+
+class TimedCursor(sqlite3.Cursor):
+    def execute(self, sql, parameters=()):
+        started = time.perf_counter()
+        try:
+            return super().execute(sql, parameters)
+        finally:
+            _record_statement(sql, time.perf_counter() - started)
+
+    def executemany(self, sql, seq_of_parameters):
+        started = time.perf_counter()
+        try:
+            return super().executemany(sql, seq_of_parameters)
+        finally:
+            _record_statement(sql, time.perf_counter() - started)
+
+
+class TimedConnection(sqlite3.Connection):
+    # Connection.execute builds its cursor internally, so route it through a TimedCursor
+    def cursor(self, factory=TimedCursor):
+        return super().cursor(factory)
+
+    def execute(self, sql, parameters=()):
+        return self.cursor().execute(sql, parameters)
+
+    def executemany(self, sql, seq_of_parameters):
+        return self.cursor().executemany(sql, seq_of_parameters)
+
+
+class Database:
+    def __init__(self, path: str, pool_size: int = DB_POOL_SIZE):
+        self.path = path
+        self.pool_size = pool_size
+        self._idle: "queue.LifoQueue[sqlite3.Connection]" = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(pool_size)
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(
+            self.path,
+            timeout=DB_BUSY_TIMEOUT_MS / 1000,
+            # Pooled connections move between worker threads, one holder at a time
+            check_same_thread=False,
+            cached_statements=DB_STATEMENT_CACHE_SIZE,
+            factory=TimedConnection,
+        )
+        conn.row_factory = sqlite3.Row
+        # WAL lets readers proceed while a writer holds the lock
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA mmap_size={DB_MMAP_SIZE}")
+        conn.execute(f"PRAGMA busy_timeout={DB_BUSY_TIMEOUT_MS}")
+        return conn
+
+    @contextmanager
+    def connection(self) -> Iterator[sqlite3.Connection]:
+        """Borrow a pooled connection.
+
+        Pending changes are committed when the block exits normally and rolled
+        back if it raises, so a connection always goes back to the pool clean.
+        """
+        if not self._slots.acquire(timeout=DB_POOL_TIMEOUT):
+            raise RuntimeError(f"Timed out waiting for a connection to {self.path}")
+        try:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = self._connect()
+            try:
+                yield conn
+                if conn.in_transaction:
+                    conn.commit()
+            except BaseException:
+                if conn.in_transaction:
+                    conn.rollback()
+                raise
+            finally:
+                self._idle.put(conn)
+        finally:
+            self._slots.release()
+
+    def _call(self, fn: Callable[..., T], args: tuple) -> T:
+        with self.connection() as conn:
+            return fn(conn, *args)
+
+    async def run(self, fn: Callable[..., T], *args: Any) -> T:
+        """Run ``fn(conn, *args)`` on the database executor."""
+        if self._executor is None:
+            # One executor thread per pooled connection, so queued work waits
+            # here instead of parking threads on the pool semaphore
+            self._executor = ThreadPoolExecutor(max_workers=self.pool_size, thread_name_prefix="db")
+        loop = asyncio.get_running_loop()
+        # run_in_executor does not carry context over; copy it so statements join the caller's trace
+        context = contextvars.copy_context()
+        return await loop.run_in_executor(self._executor, context.run, self._call, fn, args)
+
+    async def fetchone(self, sql: str, params: tuple = ()) -> Optional[sqlite3.Row]:
+        return await self.run(lambda conn: conn.execute(sql, params).fetchone())
+
+    async def fetchall(self, sql: str, params: tuple = ()) -> List[sqlite3.Row]:
+        return await self.run(lambda conn: conn.execute(sql, params).fetchall())
+
+    async def execute(self, sql: str, params: tuple = ()) -> sqlite3.Cursor:
+        """Execute and commit a single statement; the returned cursor is only
+        good for ``rowcount`` and ``lastrowid``."""
+        return await self.run(lambda conn: conn.execute(sql, params))
+
+    def close(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
@@ -0,0 +1,318 @@
+"""Asynchronous event publishing.
+
+One long-lived producer is created at startup. Handlers only enqueue events
+on a bounded in-process queue; a background task drains it in batches, so an
+HTTP response never waits on a broker round trip. When the queue is full new
+events are dropped and counted rather than blocking the request.
+
+``EventSubscriber`` is the consuming side: it follows a topic from a
+background thread and hands each event to a callback on the event loop.
+
+Each event carries the publisher's ``traceparent`` in its message headers, and
+the subscriber handles it in a consumer span of that trace.
+
+Set ``EVENT_BROKER=memory`` to swap Kafka for the process-wide
+``InMemoryBroker``, which keeps published messages in a list, delivers them to
+in-process subscribers and needs no running broker.
+"""
+import asyncio
+import json
+import os
+import threading
+import time
+from collections import defaultdict
+from typing import Callable, Dict, List, Optional, Tuple
+
+from common.metrics import EVENT_PUBLISH_DURATION, EVENTS_PUBLISHED
+from common.tracing import TRACEPARENT_HEADER, extract, span
+
+# Configuration
+EVENT_BROKER = os.getenv("EVENT_BROKER", "kafka")
+KAFKA_LINGER_MS = int(os.getenv("KAFKA_LINGER_MS", "20"))
+KAFKA_BATCH_SIZE = int(os.getenv("KAFKA_BATCH_SIZE", str(64 * 1024)))
+KAFKA_COMPRESSION = os.getenv("KAFKA_COMPRESSION", "gzip")
+KAFKA_ACKS = os.getenv("KAFKA_ACKS", "1")
+EVENT_QUEUE_SIZE = int(os.getenv("EVENT_QUEUE_SIZE", "10000"))
+EVENT_DRAIN_BATCH = int(os.getenv("EVENT_DRAIN_BATCH", "500"))
+EVENT_SHUTDOWN_TIMEOUT = float(os.getenv("EVENT_SHUTDOWN_TIMEOUT", "5"))
+EVENT_RECONNECT_DELAY = float(os.getenv("EVENT_RECONNECT_DELAY", "5"))
+
+
+def serialize(value) -> bytes:
+    # Pre-encoded payloads (e.g. relayed from an outbox) go out untouched
+    if isinstance(value, bytes):
+        return value
+    return json.dumps(value, default=str).encode("utf-8")
+
+
+def deserialize(value) -> dict:
+    return json.loads(value) if isinstance(value, (bytes, str)) else value
+
+
+def trace_headers(topic: str) -> List[Tuple[str, bytes]]:
+    """Kafka headers linking a message to the current trace through a producer span."""
+    with span(f"{topic} publish", "producer", attributes={"messaging.destination": topic}) as producer_span:
+        return [(TRACEPARENT_HEADER, producer_span.traceparent.encode("ascii"))]
+
+
+def header_value(headers, name: str) -> Optional[bytes]:
+    for key, value in headers or ():
+        if key == name:
+            return value
+    return None
+
+
+class InMemoryBroker:
+    """Producer stand-in with the subset of the KafkaProducer API we use."""
+
+    def __init__(self):
+        self.messages: Dict[str, List[dict]] = defaultdict(list)
+        self.subscribers: Dict[str, List[Callable[[dict, list], None]]] = defaultdict(list)
+
+    def send(self, topic: str, value: dict, key: Optional[bytes] = None, headers=None):
+        self.messages[topic].append({"key": key, "value": value, "headers": headers or []})
+        for callback in list(self.subscribers[topic]):
+            callback(deserialize(value), headers or [])
+
+    def subscribe(self, topic: str, callback: Callable[[dict, list], None]):
+        self.subscribers[topic].append(callback)
+
+    def unsubscribe(self, topic: str, callback: Callable[[dict, list], None]):
+        if callback in self.subscribers[topic]:
+            self.subscribers[topic].remove(callback)
+
+    def flush(self, timeout: Optional[float] = None):
+        pass
+
+    def close(self, timeout: Optional[float] = None):
+        pass
+
+
+def kafka_producer_factory(bootstrap_servers: str) -> Callable[[], object]:
+    def create():
+        from kafka import KafkaProducer
+        return KafkaProducer(
+            bootstrap_servers=bootstrap_servers,
+            value_serializer=serialize,
+            linger_ms=KAFKA_LINGER_MS,
+            batch_size=KAFKA_BATCH_SIZE,
+            compression_type=KAFKA_COMPRESSION,
+            acks=int(KAFKA_ACKS) if KAFKA_ACKS.isdigit() else KAFKA_ACKS,
+        )
+    return create
+
+
+# Shared by every service running in this process when EVENT_BROKER=memory
+memory_broker = InMemoryBroker()
+
+
+def producer_factory(bootstrap_servers: str) -> Callable[[], object]:
+    if EVENT_BROKER == "memory":
+        return lambda: memory_broker
+    return kafka_producer_factory(bootstrap_servers)
+
+
+class EventPublisher:
+    def __init__(
+        self,
+        create_producer: Callable[[], object],
+        queue_size: int = EVENT_QUEUE_SIZE,
+        batch_size: int = EVENT_DRAIN_BATCH,
+    ):
+        self.create_producer = create_producer
+        self.batch_size = batch_size
+        self.producer = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._queue_size = queue_size
+        self._task: Optional[asyncio.Task] = None
+        # Backpressure and delivery counters
+        self.published = 0
+        self.failed = 0
+        self.dropped = 0
+        self.last_batch_size = 0
+        self.last_flush_ms = 0.0
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        self._queue = asyncio.Queue(maxsize=self._queue_size)
+        self._task = asyncio.create_task(self._drain())
+
+    def _enqueue(self, item: tuple) -> bool:
+        try:
+            self._queue.put_nowait(item)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            EVENTS_PUBLISHED.inc(publisher="events", result="dropped")
+            return False
+        return True
+
+    def publish(self, topic: str, event: dict, key: Optional[str] = None) -> bool:
+        """Enqueue an event without waiting; returns False if it was dropped.
+
+        Safe to call from sync handlers running in the threadpool.
+        """
+        if self._queue is None:
+            self.dropped += 1
+            EVENTS_PUBLISHED.inc(publisher="events", result="dropped")
+            return False
+        try:
+            on_loop = asyncio.get_running_loop() is self._loop
+        except RuntimeError:
+            on_loop = False
+        item = (topic, event, key, trace_headers(topic))
+        if on_loop:
+            return self._enqueue(item)
+        self._loop.call_soon_threadsafe(self._enqueue, item)
+        return True
+
+    def _ensure_producer(self):
+        if self.producer is None:
+            self.producer = self.create_producer()
+        return self.producer
+
+    def _send_batch(self, batch: list):
+        producer = self._ensure_producer()
+        for topic, event, key, headers in batch:
+            producer.send(topic, value=event, key=key.encode("utf-8") if key else None, headers=headers)
+        producer.flush()
+
+    async def _drain(self):
+        # Connect in the background so a slow or absent broker never delays startup
+        try:
+            await asyncio.to_thread(self._ensure_producer)
+        except Exception as e:
+            print(f"Kafka producer unavailable, retrying on next publish: {e}")
+        while True:
+            item = await self._queue.get()
+            if item is None:
+                return
+            batch = [item]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                item = self._queue.get_nowait()
+                if item is None:
+                    await self._flush(batch)
+                    return
+                batch.append(item)
+            await self._flush(batch)
+
+    async def _flush(self, batch: list):
+        started = time.perf_counter()
+        try:
+            # The Kafka client blocks on metadata and flush, so keep it off the loop
+            await asyncio.to_thread(self._send_batch, batch)
+            self.published += len(batch)
+            EVENTS_PUBLISHED.inc(len(batch), publisher="events", result="ok")
+        except Exception as e:
+            self.failed += len(batch)
+            EVENTS_PUBLISHED.inc(len(batch), publisher="events", result="failed")
+            print(f"Kafka publish error (non-critical): {e}")
+        elapsed = time.perf_counter() - started
+        EVENT_PUBLISH_DURATION.observe(elapsed, publisher="events")
+        self.last_batch_size = len(batch)
+        self.last_flush_ms = elapsed * 1000
+
+    async def _finish(self):
+        # The sentinel queues up behind pending events, so they are sent first
+        await self._queue.put(None)
+        await self._task
+
+    async def stop(self):
+        if self._task is not None:
+            try:
+                await asyncio.wait_for(self._finish(), EVENT_SHUTDOWN_TIMEOUT)
+            except asyncio.TimeoutError:
+                self.failed += self._queue.qsize()
+            self._task = None
+        if self.producer is not None:
+            await asyncio.to_thread(self.producer.close, EVENT_SHUTDOWN_TIMEOUT)
+            self.producer = None
+
+    def stats(self) -> dict:
+        return {
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "capacity": self._queue_size,
+            "published": self.published,
+            "failed": self.failed,
+            "dropped": self.dropped,
+            "last_batch_size": self.last_batch_size,
+            "last_flush_ms": round(self.last_flush_ms, 2),
+        }
+
+
+class EventSubscriber:
+    def __init__(
+        self,
+        topic: str,
+        bootstrap_servers: str,
+        handler: Callable[[dict], None],
+        service: Optional[str] = None,
+    ):
+        self.topic = topic
+        self.bootstrap_servers = bootstrap_servers
+        self.handler = handler
+        # Names the consuming service on the spans of handled events
+        self.service = service
+        self.received = 0
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._stop = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def _deliver(self, event: dict, headers=None):
+        # Called from the consumer (or producer) thread; run the handler on the loop
+        self._loop.call_soon_threadsafe(self._handle, event, extract(header_value(headers, TRACEPARENT_HEADER)))
+
+    def _handle(self, event: dict, parent=None):
+        self.received += 1
+        try:
+            with span(
+                f"{self.topic} process",
+                "consumer",
+                parent,
+                self.service,
+                attributes={"messaging.destination": self.topic},
+            ):
+                self.handler(event)
+        except Exception as e:
+            print(f"Error handling {self.topic} event: {e}")
+
+    def _consume(self):
+        while not self._stop.is_set():
+            try:
+                from kafka import KafkaConsumer
+                # No group: every replica sees every event
+                consumer = KafkaConsumer(
+                    self.topic,
+                    bootstrap_servers=self.bootstrap_servers,
+                    group_id=None,
+                    auto_offset_reset="latest",
+                    value_deserializer=deserialize,
+                )
+                try:
+                    while not self._stop.is_set():
+                        for records in consumer.poll(timeout_ms=500).values():
+                            for record in records:
+                                self._deliver(record.value, record.headers)
+                finally:
+                    consumer.close()
+            except Exception as e:
+                print(f"Kafka consumer error on {self.topic} (non-critical): {e}")
+                self._stop.wait(EVENT_RECONNECT_DELAY)
+
+    async def start(self):
+        self._loop = asyncio.get_running_loop()
+        if EVENT_BROKER == "memory":
+            memory_broker.subscribe(self.topic, self._deliver)
+            return
+        self._stop.clear()
+        self._thread = threading.Thread(target=self._consume, name=f"consume-{self.topic}", daemon=True)
+        self._thread.start()
+
+    async def stop(self):
+        if EVENT_BROKER == "memory":
+            memory_broker.unsubscribe(self.topic, self._deliver)
+            return
+        self._stop.set()
+        if self._thread is not None:
+            await asyncio.to_thread(self._thread.join, EVENT_SHUTDOWN_TIMEOUT)
+            self._thread = None
@@ -0,0 +1,132 @@
+"""Server-sent event feeds.
+
+A ``ChangeFeed`` fans change events out to every connected
+``text/event-stream`` client, so dashboards receive deltas as they happen
+instead of polling. Services feed it from their own event topic through an
+``EventSubscriber``; every replica consumes the whole topic, so a client
+connected to any replica sees every change.
+
+Each event gets an id and the last ``FEED_HISTORY`` events are kept, so a
+client that reconnects with ``Last-Event-ID`` (EventSource does this on its
+own) gets what it missed. If the gap cannot be replayed, or a client falls
+more than ``FEED_QUEUE_SIZE`` events behind, it is sent a ``reset`` event and
+should reload. Comment lines every ``FEED_HEARTBEAT_INTERVAL`` seconds keep
+idle connections open through proxies.
+"""
+import asyncio
+import json
+import os
+import uuid
+from collections import deque
+from typing import AsyncIterator, Deque, List, Optional, Set, Tuple
+
+from fastapi import HTTPException, Request
+from fastapi.responses import StreamingResponse
+
+# Configuration
+FEED_QUEUE_SIZE = int(os.getenv("FEED_QUEUE_SIZE", "256"))
+FEED_HISTORY = int(os.getenv("FEED_HISTORY", "1000"))
+FEED_HEARTBEAT_INTERVAL = float(os.getenv("FEED_HEARTBEAT_INTERVAL", "15"))
+FEED_MAX_SUBSCRIBERS = int(os.getenv("FEED_MAX_SUBSCRIBERS", "1000"))
+FEED_RETRY_MS = int(os.getenv("FEED_RETRY_MS", "3000"))
+
+RESET_MESSAGE = "event: reset\ndata: {}\n\n"
+HEARTBEAT_MESSAGE = ": keep-alive\n\n"
+
+
+def format_event(event_id: str, event_type: str, data: dict) -> str:
+    return f"id: {event_id}\nevent: {event_type}\ndata: {json.dumps(data, default=str)}\n\n"
+
+
+class ChangeFeed:
+    def __init__(
+        self,
+        queue_size: int = FEED_QUEUE_SIZE,
+        history: int = FEED_HISTORY,
+        heartbeat_interval: float = FEED_HEARTBEAT_INTERVAL,
+        max_subscribers: int = FEED_MAX_SUBSCRIBERS,
+    ):
+        self.queue_size = queue_size
+        self.heartbeat_interval = heartbeat_interval
+        self.max_subscribers = max_subscribers
+        # Ids are only meaningful to the replica that issued them
+        self._instance = uuid.uuid4().hex[:8]
+        self._sequence = 0
+        self._history: Deque[Tuple[int, str]] = deque(maxlen=history)
+        self._subscribers: Set[asyncio.Queue] = set()
+        self.published = 0
+        self.resets = 0
+
+    def publish(self, event_type: str, data: dict):
+        """Send an event to every subscriber; call on the event loop."""
+        self._sequence += 1
+        message = format_event(f"{self._instance}-{self._sequence}", event_type, data)
+        self._history.append((self._sequence, message))
+        self.published += 1
+        for queue in self._subscribers:
+            try:
+                queue.put_nowait(message)
+            except asyncio.QueueFull:
+                # Too far behind to catch up event by event; tell it to reload
+                while not queue.empty():
+                    queue.get_nowait()
+                queue.put_nowait(RESET_MESSAGE)
+                self.resets += 1
+
+    def publish_event(self, event: dict):
+        """``EventSubscriber`` handler that forwards a service event unchanged."""
+        self.publish(event.get("event_type", "message"), event.get("data", {}))
+
+    def _missed(self, last_event_id: Optional[str]) -> Optional[List[str]]:
+        """Events after ``last_event_id``, or None if they can no longer be replayed."""
+        if last_event_id is None:
+            return []
+        instance, _, sequence = last_event_id.partition("-")
+        if instance != self._instance or not sequence.isdigit():
+            return None
+        since = int(sequence)
+        if since >= self._sequence:
+            return []
+        if not self._history or self._history[0][0] > since + 1:
+            return None
+        return [message for event_sequence, message in self._history if event_sequence > since]
+
+    async def _stream(self, request: Request, last_event_id: Optional[str]) -> AsyncIterator[str]:
+        # Subscribe and compute the backlog in one step so no event falls in between
+        queue: asyncio.Queue = asyncio.Queue(maxsize=self.queue_size)
+        missed = self._missed(last_event_id)
+        self._subscribers.add(queue)
+        try:
+            yield f"retry: {FEED_RETRY_MS}\n\n"
+            if missed is None:
+                self.resets += 1
+                yield RESET_MESSAGE
+            else:
+                for message in missed:
+                    yield message
+            while True:
+                try:
+                    yield await asyncio.wait_for(queue.get(), self.heartbeat_interval)
+                except asyncio.TimeoutError:
+                    if await request.is_disconnected():
+                        return
+                    yield HEARTBEAT_MESSAGE
+        finally:
+            self._subscribers.discard(queue)
+
+    def response(self, request: Request, last_event_id: Optional[str] = None) -> StreamingResponse:
+        if len(self._subscribers) >= self.max_subscribers:
+            raise HTTPException(status_code=503, detail="Too many feed subscribers")
+        return StreamingResponse(
+            self._stream(request, last_event_id),
+            media_type="text/event-stream",
+            # Stop nginx and other proxies from buffering the stream
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+        )
+
+    def stats(self) -> dict:
+        return {
+            "subscribers": len(self._subscribers),
+            "published": self.published,
+            "resets": self.resets,
+        }
@@ -0,0 +1,121 @@
+"""Pooled HTTP client for calls between services.
+
+Each service creates one ``ServiceClient`` at startup and closes it at
+shutdown, so every outbound call reuses keep-alive connections from a single
+bounded pool instead of opening a fresh TCP connection per request.
+
+Every attempt runs in a client span whose ``traceparent`` is sent along, so
+the upstream's spans join the caller's trace.
+"""
+import asyncio
+import os
+import random
+import time
+from typing import Dict, Optional
+
+import httpx
+
+from common.metrics import HTTP_CLIENT_DURATION, HTTP_CLIENT_RETRIES
+from common.tracing import TRACEPARENT_HEADER, span
+
+# Configuration
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "30"))
+HTTP_CONNECT_TIMEOUT = float(os.getenv("HTTP_CONNECT_TIMEOUT", "1.0"))
+HTTP_RETRIES = int(os.getenv("HTTP_RETRIES", "2"))
+HTTP_RETRY_BACKOFF = float(os.getenv("HTTP_RETRY_BACKOFF", "0.05"))
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "false").lower() == "true"
+
+# Only safe methods are retried by default; a retried POST could create a duplicate order or payment
+RETRYABLE_METHODS = {"GET", "HEAD"}
+RETRYABLE_STATUS_CODES = {502, 503, 504}
+
+
+class Upstream:
+    def __init__(self, name: str, base_url: str, timeout: float = 5.0):
+        self.name = name
+        self.base_url = base_url.rstrip("/")
+        self.timeout = httpx.Timeout(timeout, connect=min(HTTP_CONNECT_TIMEOUT, timeout))
+
+
+class ServiceClient:
+    def __init__(self, *upstreams: Upstream):
+        self.upstreams: Dict[str, Upstream] = {upstream.name: upstream for upstream in upstreams}
+        self._client: Optional[httpx.AsyncClient] = None
+
+    async def start(self):
+        self._client = httpx.AsyncClient(
+            limits=httpx.Limits(
+                max_connections=HTTP_MAX_CONNECTIONS,
+                max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+            ),
+            # HTTP/2 is negotiated via ALPN, so plain-HTTP upstreams keep using HTTP/1.1
+            http2=HTTP2_ENABLED,
+        )
+
+    async def close(self):
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        if self._client is None:
+            raise RuntimeError("ServiceClient used before start()")
+        return self._client
+
+    async def request(self, upstream: str, method: str, path: str, **kwargs) -> httpx.Response:
+        target = self.upstreams[upstream]
+        kwargs.setdefault("timeout", target.timeout)
+        url = f"{target.base_url}{path}"
+        # A request carrying an idempotency key is deduplicated upstream, so it is safe to retry too
+        idempotent = "Idempotency-Key" in (kwargs.get("headers") or {})
+        retries = HTTP_RETRIES if method.upper() in RETRYABLE_METHODS or idempotent else 0
+
+        headers = dict(kwargs.pop("headers", None) or {})
+        attributes = {"http.method": method.upper(), "http.url": url, "peer.service": upstream}
+
+        for attempt in range(retries + 1):
+            if attempt:
+                HTTP_CLIENT_RETRIES.inc(upstream=upstream)
+            with span(f"{method.upper()} {upstream}", "client", attributes=attributes) as client_span:
+                client_span.attributes["http.attempt"] = attempt
+                headers[TRACEPARENT_HEADER] = client_span.traceparent
+                started = time.perf_counter()
+                try:
+                    response = await self.client.request(method, url, headers=headers, **kwargs)
+                except httpx.TransportError:
+                    HTTP_CLIENT_DURATION.observe(
+                        time.perf_counter() - started, upstream=upstream, method=method.upper(), status="error"
+                    )
+                    if attempt == retries:
+                        raise
+                    client_span.status = "error"
+                else:
+                    HTTP_CLIENT_DURATION.observe(
+                        time.perf_counter() - started,
+                        upstream=upstream,
+                        method=method.upper(),
+                        status=str(response.status_code),
+                    )
+                    client_span.attributes["http.status_code"] = response.status_code
+                    if response.status_code >= 500:
+                        client_span.status = "error"
+                    if response.status_code not in RETRYABLE_STATUS_CODES or attempt == retries:
+                        return response
+            # Full jitter keeps retrying replicas from hitting the upstream in lockstep
+            await asyncio.sleep(random.uniform(0, HTTP_RETRY_BACKOFF * 2 ** attempt))
+
+    async def get(self, upstream: str, path: str, **kwargs) -> httpx.Response:
+        return await self.request(upstream, "GET", path, **kwargs)
+
+    async def post(self, upstream: str, path: str, **kwargs) -> httpx.Response:
+        return await self.request(upstream, "POST", path, **kwargs)
+
+    async def put(self, upstream: str, path: str, **kwargs) -> httpx.Response:
+        return await self.request(upstream, "PUT", path, **kwargs)
+
+    async def delete(self, upstream: str, path: str, **kwargs) -> httpx.Response:
+        return await self.request(upstream, "DELETE", path, **kwargs)
@@ -0,0 +1,256 @@
+"""Idempotency keys for unsafe requests.
+
+A client that sends an ``Idempotency-Key`` header on a POST can retry it
+freely. The key is claimed in the ``idempotency_keys`` table before the
+handler runs, and the response is stored with it once the handler finishes;
+every repeat gets the stored response back instead of executing again.
+Only successes and validation errors are stored; a request rejected for the
+current state (409, 404, or a ``TransientHTTPException`` of any status) or
+failing on the server releases its key, so a retry with the same key runs again.
+
+Duplicates that arrive while the first request is still running are
+coalesced: in the same process they wait for its result, and on another
+replica they get 409 until it completes. Reusing a key for a different
+request is rejected with 422. Rows expire after ``IDEMPOTENCY_TTL_HOURS`` and
+are purged by a background task.
+"""
+import asyncio
+import hashlib
+import json
+import os
+from typing import Any, Awaitable, Callable, Dict, Optional, Tuple, Type
+
+from fastapi import HTTPException, Response
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+from common.db import Database
+
+# Configuration
+IDEMPOTENCY_TTL_HOURS = int(os.getenv("IDEMPOTENCY_TTL_HOURS", "24"))
+IDEMPOTENCY_LOCK_TIMEOUT = int(os.getenv("IDEMPOTENCY_LOCK_TIMEOUT", "60"))
+IDEMPOTENCY_CLEANUP_INTERVAL = float(os.getenv("IDEMPOTENCY_CLEANUP_INTERVAL", "300"))
+IDEMPOTENCY_MAX_KEY_LENGTH = 255
+
+# Client errors that depend only on the request are stored and replayed. Others,
+# such as 409 conflicts and 404s, reflect current state, so a retry runs again.
+REPLAYED_ERROR_STATUS_CODES = {400, 422}
+
+IDEMPOTENCY_KEY_HEADER = "Idempotency-Key"
+REPLAYED_HEADER = "Idempotent-Replayed"
+
+# Schema statements for a service migration that adds the idempotency table.
+# A NULL status_code marks a key whose request is still executing.
+IDEMPOTENCY_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS idempotency_keys (
+        scope TEXT NOT NULL,
+        key TEXT NOT NULL,
+        fingerprint TEXT NOT NULL,
+        status_code INTEGER,
+        body TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (scope, key)
+    ) WITHOUT ROWID
+    """,
+    "CREATE INDEX IF NOT EXISTS idx_idempotency_keys_created_at ON idempotency_keys(created_at)",
+]
+
+
+class TransientHTTPException(HTTPException):
+    """An error response that reflects current state rather than the request.
+
+    It reaches the client like any ``HTTPException`` but is never stored
+    against an idempotency key, whatever its status code.
+    """
+
+
+def fingerprint(*parts: Any) -> str:
+    """Stable hash of whatever identifies the request (path parameters, body)."""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+class IdempotencyStore:
+    def __init__(
+        self,
+        db: Database,
+        ttl_hours: int = IDEMPOTENCY_TTL_HOURS,
+        lock_timeout: int = IDEMPOTENCY_LOCK_TIMEOUT,
+        cleanup_interval: float = IDEMPOTENCY_CLEANUP_INTERVAL,
+    ):
+        self.db = db
+        self.ttl_hours = ttl_hours
+        self.lock_timeout = lock_timeout
+        self.cleanup_interval = cleanup_interval
+        self._inflight: Dict[Tuple[str, str], Tuple[str, asyncio.Future]] = {}
+        self._task: Optional[asyncio.Task] = None
+        self.executed = 0
+        self.replayed = 0
+        self.coalesced = 0
+        self.purged = 0
+
+    async def start(self):
+        self._task = asyncio.create_task(self._cleanup_loop())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def _claim(self, conn, scope: str, key: str, request_fingerprint: str):
+        """Claim ``key`` for this request; returns the existing row if it is already taken."""
+        # Expired keys and claims abandoned by a crashed worker can be reused
+        conn.execute(
+            "DELETE FROM idempotency_keys WHERE scope = ? AND key = ? AND ("
+            "created_at < datetime('now', ?) OR "
+            "(status_code IS NULL AND created_at < datetime('now', ?)))",
+            (scope, key, f"-{self.ttl_hours} hours", f"-{self.lock_timeout} seconds")
+        )
+        cursor = conn.execute(
+            "INSERT OR IGNORE INTO idempotency_keys (scope, key, fingerprint) VALUES (?, ?, ?)",
+            (scope, key, request_fingerprint)
+        )
+        if cursor.rowcount == 1:
+            conn.commit()
+            return None
+        return conn.execute(
+            "SELECT fingerprint, status_code, body FROM idempotency_keys WHERE scope = ? AND key = ?",
+            (scope, key)
+        ).fetchone()
+
+    def _complete(self, conn, scope: str, key: str, status_code: int, body: str):
+        conn.execute(
+            "UPDATE idempotency_keys SET status_code = ?, body = ? WHERE scope = ? AND key = ?",
+            (status_code, body, scope, key)
+        )
+        conn.commit()
+
+    def _release(self, conn, scope: str, key: str):
+        conn.execute(
+            "DELETE FROM idempotency_keys WHERE scope = ? AND key = ? AND status_code IS NULL",
+            (scope, key)
+        )
+        conn.commit()
+
+    def _purge(self, conn) -> int:
+        cursor = conn.execute(
+            "DELETE FROM idempotency_keys WHERE created_at < datetime('now', ?)",
+            (f"-{self.ttl_hours} hours",)
+        )
+        conn.commit()
+        return cursor.rowcount
+
+    async def _cleanup_loop(self):
+        while True:
+            await asyncio.sleep(self.cleanup_interval)
+            try:
+                self.purged += await self.db.run(self._purge)
+            except Exception as e:
+                print(f"Idempotency key cleanup error (non-critical): {e}")
+
+    async def _execute(
+        self,
+        scope: str,
+        key: str,
+        request_fingerprint: str,
+        handler: Callable[[], Awaitable[Any]],
+        response_model: Optional[Type[BaseModel]],
+    ) -> Tuple[int, Any, bool]:
+        existing = await self.db.run(self._claim, scope, key, request_fingerprint)
+        if existing is not None:
+            if existing["fingerprint"] != request_fingerprint:
+                raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different request")
+            if existing["status_code"] is None:
+                raise HTTPException(status_code=409, detail="A request with this Idempotency-Key is still in progress")
+            self.replayed += 1
+            return existing["status_code"], json.loads(existing["body"]), True
+
+        try:
+            result = await handler()
+            if response_model is not None:
+                result = response_model.model_validate(result)
+            status_code, body = 200, jsonable_encoder(result)
+        except HTTPException as e:
+            # Validation errors are part of the outcome; anything else may succeed on retry
+            if e.status_code not in REPLAYED_ERROR_STATUS_CODES or isinstance(e, TransientHTTPException):
+                await self.db.run(self._release, scope, key)
+                raise
+            status_code, body = e.status_code, {"detail": e.detail}
+        except Exception:
+            await self.db.run(self._release, scope, key)
+            raise
+        await self.db.run(self._complete, scope, key, status_code, json.dumps(body))
+        self.executed += 1
+        return status_code, body, False
+
+    async def execute(
+        self,
+        scope: str,
+        key: Optional[str],
+        request_fingerprint: str,
+        handler: Callable[[], Awaitable[Any]],
+        response_model: Optional[Type[BaseModel]] = None,
+        response: Optional[Response] = None,
+    ) -> Any:
+        """Run ``handler`` at most once per ``(scope, key)``.
+
+        Without a key the handler simply runs. With one, the result comes back
+        as a ``JSONResponse``, carrying any headers the handler set on
+        ``response``.
+        """
+        if key is None:
+            return await handler()
+        if not key or len(key) > IDEMPOTENCY_MAX_KEY_LENGTH:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Idempotency-Key must be 1-{IDEMPOTENCY_MAX_KEY_LENGTH} characters"
+            )
+
+        ident = (scope, key)
+        if ident in self._inflight:
+            inflight_fingerprint, future = self._inflight[ident]
+            if inflight_fingerprint != request_fingerprint:
+                raise HTTPException(status_code=422, detail="Idempotency-Key was already used for a different request")
+            self.coalesced += 1
+            status_code, body, _ = await asyncio.shield(future)
+            replayed = True
+        else:
+            future = asyncio.get_running_loop().create_future()
+            self._inflight[ident] = (request_fingerprint, future)
+            try:
+                status_code, body, replayed = await self._execute(
+                    scope, key, request_fingerprint, handler, response_model
+                )
+            except BaseException as e:
+                if isinstance(e, Exception):
+                    future.set_exception(e)
+                    # Mark retrieved so a failure nobody waited on is not logged
+                    future.exception()
+                else:
+                    future.cancel()
+                raise
+            finally:
+                self._inflight.pop(ident, None)
+            future.set_result((status_code, body, replayed))
+
+        result = JSONResponse(status_code=status_code, content=body)
+        if replayed:
+            result.headers[REPLAYED_HEADER] = "true"
+        elif response is not None:
+            for name, value in response.headers.items():
+                result.headers[name] = value
+        return result
+
+    def stats(self) -> dict:
+        return {
+            "executed": self.executed,
+            "replayed": self.replayed,
+            "coalesced": self.coalesced,
+            "purged": self.purged,
+            "inflight": len(self._inflight),
+        }
@@ -0,0 +1,45 @@
+"""Event loop lag monitoring.
+
+A background task sleeps for a fixed interval and records how late it wakes
+up. Anything that blocks the loop (a synchronous query, CPU-heavy work) shows
+up directly as lag.
+"""
+import asyncio
+import os
+from typing import Optional
+
+LOOP_LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", "0.5"))
+
+
+class LoopLagMonitor:
+    def __init__(self, interval: float = LOOP_LAG_INTERVAL):
+        self.interval = interval
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.lag = max(loop.time() - started - self.interval, 0.0)
+            self.max_lag = max(self.max_lag, self.lag)
+
+    def start(self):
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    def snapshot(self) -> dict:
+        return {
+            "event_loop_lag_ms": round(self.lag * 1000, 2),
+            "event_loop_lag_max_ms": round(self.max_lag * 1000, 2),
+        }
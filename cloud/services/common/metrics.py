@@ -0,0 +1,225 @@
+"""Prometheus metrics.
+
+A small registry of counters, gauges and histograms rendered in the Prometheus
+text exposition format, plus ``instrument(app, service)``, which adds the
+request middleware and a ``/metrics`` route to a FastAPI app.
+
+The metrics every service shares are defined here and recorded by the common
+modules themselves: HTTP requests by the middleware, SQL statements by
+``common.db``, outbound calls by ``common.http`` and event publishing by
+``common.events`` and ``common.outbox``. All of them are safe to update from
+worker threads.
+"""
+import re
+import threading
+import time
+from functools import lru_cache
+from typing import Dict, Iterator, List, Sequence, Tuple
+
+from starlette.requests import Request
+from starlette.responses import Response
+
+CONTENT_TYPE = "text/plain; version=0.0.4"
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DB_BUCKETS = (0.0001, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in zip(names, values)) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if not float(value).is_integer() else str(int(value))
+
+
+class Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._values: Dict[Tuple[str, ...], object] = {}
+        REGISTRY.register(self)
+
+    def _key(self, labels: dict) -> Tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self) -> Iterator[Tuple[str, List[str], List[str], float]]:
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        lines = [f"# HELP {self.name} {self.documentation}", f"# TYPE {self.name} {self.kind}"]
+        for name, label_names, label_values, value in self.samples():
+            lines.append(f"{name}{_format_labels(label_names, label_values)} {_format_value(value)}")
+        return lines
+
+
+class Counter(Metric):
+    kind = "counter"
+
+    def inc(self, amount: float = 1.0, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield self.name, list(self.labelnames), list(key), value
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1.0, **labels):
+        self.inc(-amount, **labels)
+
+
+class Histogram(Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        super().__init__(name, documentation, labelnames)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # [per-bucket counts, sum, count]
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    state[0][index] += 1
+                    break
+            state[1] += value
+            state[2] += 1
+
+    def samples(self):
+        with self._lock:
+            values = [(key, (list(state[0]), state[1], state[2])) for key, state in self._values.items()]
+        names = list(self.labelnames)
+        for key, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                yield f"{self.name}_bucket", names + ["le"], list(key) + [_format_value(bound)], cumulative
+            yield f"{self.name}_sum", names, list(key), total
+            yield f"{self.name}_count", names, list(key), count
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self._metrics[metric.name] = metric
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# HTTP server
+HTTP_REQUESTS = Counter(
+    "http_requests_total", "Requests handled, by route template and status.",
+    ("service", "method", "route", "status"),
+)
+HTTP_REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds", "Time to handle a request, by route template and status.",
+    ("service", "method", "route", "status"),
+)
+HTTP_IN_FLIGHT = Gauge("http_requests_in_flight", "Requests currently being handled.", ("service",))
+
+# Database
+DB_QUERY_DURATION = Histogram(
+    "db_query_duration_seconds", "Time to execute a SQL statement.", ("statement",), buckets=DB_BUCKETS,
+)
+
+# Outbound HTTP
+HTTP_CLIENT_DURATION = Histogram(
+    "http_client_request_duration_seconds", "Time for one call to another service, per attempt.",
+    ("upstream", "method", "status"),
+)
+HTTP_CLIENT_RETRIES = Counter("http_client_retries_total", "Retried calls to another service.", ("upstream",))
+
+# Event publishing
+EVENT_PUBLISH_DURATION = Histogram(
+    "event_publish_duration_seconds", "Time to send and flush one batch of events.", ("publisher",),
+)
+EVENTS_PUBLISHED = Counter(
+    "events_published_total", "Events handed to the broker, by outcome (ok, failed, dropped).",
+    ("publisher", "result"),
+)
+
+
+@lru_cache(maxsize=1024)
+def statement_label(sql: str) -> str:
+    """Normalize SQL into a label: whitespace collapsed, placeholder lists of any length folded."""
+    statement = re.sub(r"\s+", " ", sql).strip()
+    return re.sub(r"\(\s*\?(?:\s*,\s*\?)*\s*\)", "(?)", statement)
+
+
+class MetricsMiddleware:
+    """ASGI middleware that counts and times every HTTP request."""
+
+    def __init__(self, app, service: str):
+        self.app = app
+        self.service = service
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+
+        async def send_and_record_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        HTTP_IN_FLIGHT.inc(service=self.service)
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_and_record_status)
+        finally:
+            elapsed = time.perf_counter() - started
+            HTTP_IN_FLIGHT.dec(service=self.service)
+            # The route template keeps ids out of the labels; unmatched paths share one series
+            route = getattr(scope.get("route"), "path", "unmatched")
+            labels = {"service": self.service, "method": scope["method"], "route": route, "status": str(status)}
+            HTTP_REQUESTS.inc(**labels)
+            HTTP_REQUEST_DURATION.observe(elapsed, **labels)
+
+
+async def metrics_endpoint(request: Request) -> Response:
+    return Response(REGISTRY.render(), media_type=CONTENT_TYPE)
+
+
+def instrument(app, service: str):
+    """Record request metrics for ``app`` and serve them on ``/metrics``."""
+    app.add_middleware(MetricsMiddleware, service=service)
+    app.add_api_route("/metrics", metrics_endpoint, include_in_schema=False)
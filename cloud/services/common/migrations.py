@@ -0,0 +1,69 @@
+"""Versioned schema migrations applied at startup.
+
+Each service declares an ordered list of ``Migration`` entries. ``migrate``
+records applied versions in ``schema_migrations`` and runs only the pending
+ones, all inside one ``BEGIN IMMEDIATE`` transaction so that several workers
+starting against the same database apply each migration exactly once.
+Statements should stay idempotent (``IF NOT EXISTS``) so databases created
+before a migration existed upgrade cleanly. SQLite has no ``ADD COLUMN IF NOT
+EXISTS``, so new columns go through ``add_column``, a callable statement that
+checks ``PRAGMA table_info`` first.
+"""
+from typing import Callable, List, NamedTuple, Sequence, Union
+
+from common.db import Database
+
+
+class Migration(NamedTuple):
+    version: int
+    name: str
+    # SQL strings, or callables that take the connection
+    statements: Sequence[Union[str, Callable]]
+
+
+def add_column(table: str, column: str, definition: str) -> Callable:
+    """Statement that adds ``column`` to ``table`` unless it is already there."""
+    def statement(conn):
+        columns = {row[1] for row in conn.execute(f"PRAGMA table_info({table})")}
+        if column not in columns:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    return statement
+
+
+def migrate(db: Database, migrations: Sequence[Migration]) -> List[int]:
+    versions = [migration.version for migration in migrations]
+    if len(set(versions)) != len(versions):
+        raise ValueError("Duplicate migration versions")
+
+    applied_now = []
+    with db.connection() as conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version INTEGER PRIMARY KEY,
+                name TEXT NOT NULL,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        conn.execute("BEGIN IMMEDIATE")
+        applied = {row[0] for row in conn.execute("SELECT version FROM schema_migrations")}
+        for migration in sorted(migrations, key=lambda m: m.version):
+            if migration.version in applied:
+                continue
+            for statement in migration.statements:
+                if callable(statement):
+                    statement(conn)
+                else:
+                    conn.execute(statement)
+            conn.execute(
+                "INSERT INTO schema_migrations (version, name) VALUES (?, ?)",
+                (migration.version, migration.name)
+            )
+            applied_now.append(migration)
+        conn.commit()
+        if applied_now:
+            # Refresh planner statistics so new indexes are picked up straight away
+            conn.execute("PRAGMA optimize")
+
+    for migration in applied_now:
+        print(f"Applied migration {migration.version:03d}_{migration.name} to {db.path}")
+    return [migration.version for migration in applied_now]
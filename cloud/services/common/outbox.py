@@ -0,0 +1,207 @@
+"""Transactional outbox.
+
+Events are written to an ``outbox`` table in the same transaction as the
+business rows they describe, so an event exists if and only if the change was
+committed. ``OutboxRelay`` streams new rows to the broker in batches and only
+then advances its high-water mark in ``outbox_offsets``. A crash between the
+send and the mark re-sends that batch, which gives at-least-once delivery.
+
+Each row keeps the ``traceparent`` of the request that wrote it, and the relay
+sends it as a message header, so consumers continue the original trace.
+"""
+import asyncio
+import json
+import os
+import time
+from typing import Callable, Iterable, Optional, Tuple
+
+from common.db import Database
+from common.metrics import EVENT_PUBLISH_DURATION, EVENTS_PUBLISHED
+from common.migrations import add_column
+from common.tracing import TRACEPARENT_HEADER, span
+
+# Configuration
+OUTBOX_BATCH_SIZE = int(os.getenv("OUTBOX_BATCH_SIZE", "500"))
+OUTBOX_POLL_INTERVAL = float(os.getenv("OUTBOX_POLL_INTERVAL", "1.0"))
+OUTBOX_SEND_TIMEOUT = float(os.getenv("OUTBOX_SEND_TIMEOUT", "10"))
+OUTBOX_RETENTION_HOURS = int(os.getenv("OUTBOX_RETENTION_HOURS", "24"))
+
+
+# Schema statements for a service migration that adds the outbox
+OUTBOX_SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS outbox (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        topic TEXT NOT NULL,
+        event_key TEXT,
+        payload TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS outbox_offsets (
+        relay TEXT PRIMARY KEY,
+        last_id INTEGER NOT NULL
+    )
+    """,
+]
+
+# Follow-up migration for services created with OUTBOX_SCHEMA
+OUTBOX_TRACE_SCHEMA = [
+    add_column("outbox", "traceparent", "TEXT"),
+]
+
+
+def write_event(conn, topic: str, event: dict, key: Optional[str] = None):
+    """Stage an event inside the caller's open transaction."""
+    with span(f"{topic} publish", "producer", attributes={"messaging.destination": topic}) as producer_span:
+        conn.execute(
+            "INSERT INTO outbox (topic, event_key, payload, traceparent) VALUES (?, ?, ?, ?)",
+            (topic, key, json.dumps(event, default=str), producer_span.traceparent)
+        )
+
+
+def write_events(conn, topic: str, events: Iterable[Tuple[dict, Optional[str]]]):
+    """Stage many ``(event, key)`` pairs with one statement; they share one producer span."""
+    with span(f"{topic} publish", "producer", attributes={"messaging.destination": topic}) as producer_span:
+        rows = [
+            (topic, key, json.dumps(event, default=str), producer_span.traceparent)
+            for event, key in events
+        ]
+        producer_span.attributes["messaging.batch.message_count"] = len(rows)
+        conn.executemany(
+            "INSERT INTO outbox (topic, event_key, payload, traceparent) VALUES (?, ?, ?, ?)", rows
+        )
+
+
+class OutboxRelay:
+    def __init__(
+        self,
+        db: Database,
+        create_producer: Callable[[], object],
+        name: str = "kafka",
+        batch_size: int = OUTBOX_BATCH_SIZE,
+        poll_interval: float = OUTBOX_POLL_INTERVAL,
+    ):
+        self.db = db
+        self.create_producer = create_producer
+        self.name = name
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.producer = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self.high_water_mark = 0
+        self.pending = 0
+        self.published = 0
+        self.failed = 0
+        self.last_batch_size = 0
+        self.last_send_ms = 0.0
+
+    async def start(self):
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    def notify(self):
+        """Wake the relay right after a commit instead of waiting for the next poll."""
+        if self._wakeup is not None:
+            self._wakeup.set()
+
+    def _fetch_batch(self, conn) -> list:
+        row = conn.execute("SELECT last_id FROM outbox_offsets WHERE relay = ?", (self.name,)).fetchone()
+        self.high_water_mark = row["last_id"] if row else 0
+        latest = conn.execute("SELECT MAX(id) FROM outbox").fetchone()[0] or 0
+        self.pending = max(latest - self.high_water_mark, 0)
+        return conn.execute(
+            "SELECT id, topic, event_key, payload, traceparent FROM outbox WHERE id > ? ORDER BY id LIMIT ?",
+            (self.high_water_mark, self.batch_size)
+        ).fetchall()
+
+    def _send(self, rows: list):
+        if self.producer is None:
+            self.producer = self.create_producer()
+        futures = [
+            self.producer.send(
+                row["topic"],
+                value=row["payload"].encode("utf-8"),
+                key=row["event_key"].encode("utf-8") if row["event_key"] else None,
+                headers=[(TRACEPARENT_HEADER, row["traceparent"].encode("ascii"))] if row["traceparent"] else None,
+            )
+            for row in rows
+        ]
+        self.producer.flush()
+        # Surface per-record delivery failures so the mark is not advanced past them
+        for future in futures:
+            if future is not None:
+                future.get(timeout=OUTBOX_SEND_TIMEOUT)
+
+    def _advance(self, conn, last_id: int):
+        conn.execute(
+            "INSERT INTO outbox_offsets (relay, last_id) VALUES (?, ?) "
+            "ON CONFLICT(relay) DO UPDATE SET last_id = excluded.last_id",
+            (self.name, last_id)
+        )
+        conn.execute(
+            "DELETE FROM outbox WHERE id <= ? AND created_at < datetime('now', ?)",
+            (last_id, f"-{OUTBOX_RETENTION_HOURS} hours")
+        )
+        conn.commit()
+
+    async def relay_once(self) -> int:
+        rows = await self.db.run(self._fetch_batch)
+        if not rows:
+            return 0
+        started = time.perf_counter()
+        try:
+            await asyncio.to_thread(self._send, rows)
+        except Exception:
+            self.failed += len(rows)
+            EVENTS_PUBLISHED.inc(len(rows), publisher="outbox", result="failed")
+            EVENT_PUBLISH_DURATION.observe(time.perf_counter() - started, publisher="outbox")
+            raise
+        elapsed = time.perf_counter() - started
+        EVENTS_PUBLISHED.inc(len(rows), publisher="outbox", result="ok")
+        EVENT_PUBLISH_DURATION.observe(elapsed, publisher="outbox")
+        self.last_send_ms = elapsed * 1000
+        await self.db.run(self._advance, rows[-1]["id"])
+        self.high_water_mark = rows[-1]["id"]
+        self.pending = max(self.pending - len(rows), 0)
+        self.published += len(rows)
+        self.last_batch_size = len(rows)
+        return len(rows)
+
+    async def _run(self):
+        while True:
+            try:
+                if await self.relay_once() == self.batch_size:
+                    # A full batch means there is more backlog; keep going
+                    continue
+            except Exception as e:
+                print(f"Outbox relay error, will retry: {e}")
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.poll_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        if self.producer is not None:
+            await asyncio.to_thread(self.producer.close, OUTBOX_SEND_TIMEOUT)
+            self.producer = None
+
+    def stats(self) -> dict:
+        return {
+            "high_water_mark": self.high_water_mark,
+            "pending": self.pending,
+            "published": self.published,
+            "failed": self.failed,
+            "last_batch_size": self.last_batch_size,
+            "last_send_ms": round(self.last_send_ms, 2),
+        }
@@ -0,0 +1,37 @@
+"""Opaque cursors for keyset pagination.
+
+A cursor encodes the sort key of the last row on a page, here
+``(created_at, id)``. The next page starts with a ``WHERE (created_at, id) > ?``
+range on a matching composite index, so page 1000 costs the same as page 1,
+unlike ``OFFSET``, which walks every skipped row.
+"""
+import base64
+import json
+from typing import Optional, Tuple
+
+NEXT_CURSOR_HEADER = "X-Next-Cursor"
+
+
+def encode_cursor(created_at: str, row_id: int) -> str:
+    raw = json.dumps([created_at, row_id], separators=(",", ":")).encode("utf-8")
+    return base64.urlsafe_b64encode(raw).decode("ascii").rstrip("=")
+
+
+def decode_cursor(cursor: str) -> Tuple[str, int]:
+    """Raise ``ValueError`` if the cursor was not produced by ``encode_cursor``."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        created_at, row_id = json.loads(base64.urlsafe_b64decode(padded))
+    except Exception:
+        raise ValueError("Invalid cursor")
+    if not isinstance(created_at, str) or not isinstance(row_id, int):
+        raise ValueError("Invalid cursor")
+    return created_at, row_id
+
+
+def next_cursor(rows: list, limit: int) -> Optional[str]:
+    """Cursor for the page after ``rows``, or None when this was the last page."""
+    if not rows or len(rows) < limit:
+        return None
+    last = rows[-1]
+    return encode_cursor(last["created_at"], last["id"])
@@ -0,0 +1,52 @@
+"""Per-stage request timing.
+
+A ``StageTimer`` measures the named stages of one request and renders them as
+a ``Server-Timing`` header, so the breakdown shows up in browser dev tools and
+in ``curl -i``. Each finished stage is also folded into a shared
+``StageStats``, which keeps running count/average/max figures for ``/health``.
+"""
+import time
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Optional, Tuple
+
+SERVER_TIMING_HEADER = "Server-Timing"
+
+
+class StageStats:
+    def __init__(self):
+        self._stages: Dict[str, List[float]] = {}
+
+    def record(self, stage: str, duration_ms: float):
+        # [count, total, max]
+        entry = self._stages.setdefault(stage, [0, 0.0, 0.0])
+        entry[0] += 1
+        entry[1] += duration_ms
+        entry[2] = max(entry[2], duration_ms)
+
+    def snapshot(self) -> dict:
+        return {
+            stage: {"count": count, "avg_ms": round(total / count, 2), "max_ms": round(peak, 2)}
+            for stage, (count, total, peak) in self._stages.items()
+        }
+
+
+class StageTimer:
+    def __init__(self, stats: Optional[StageStats] = None):
+        self.stats = stats
+        self.stages: List[Tuple[str, float]] = []
+
+    @contextmanager
+    def span(self, stage: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, (time.perf_counter() - started) * 1000)
+
+    def record(self, stage: str, duration_ms: float):
+        self.stages.append((stage, duration_ms))
+        if self.stats is not None:
+            self.stats.record(stage, duration_ms)
+
+    def header(self) -> str:
+        return ", ".join(f"{stage};dur={duration:.2f}" for stage, duration in self.stages)
@@ -0,0 +1,303 @@
+"""Distributed tracing with W3C trace context.
+
+``trace_requests(app, service)`` opens a server span for every request,
+continuing the trace from an incoming ``traceparent`` header. Within it, the
+common modules add child spans on their own: ``common.http`` for each outbound
+call (and forwards ``traceparent`` to the upstream), ``common.db`` for each SQL
+statement, and ``common.events``/``common.outbox`` for each published event,
+whose ``traceparent`` travels in the Kafka message headers so the consuming
+``EventSubscriber`` continues the same trace.
+
+Finished spans go to one process-wide exporter, chosen with
+``TRACE_EXPORTER``: ``none`` (the default; context is still propagated),
+``memory`` (kept in ``InMemoryExporter.spans``, for tests), ``file`` (JSON lines
+appended to ``TRACE_FILE``), ``console``, or ``package.module:factory`` for
+anything else. ``set_exporter`` swaps it at runtime.
+"""
+import importlib
+import json
+import os
+import random
+import re
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, List, NamedTuple, Optional, Union
+
+# Configuration
+TRACE_EXPORTER = os.getenv("TRACE_EXPORTER", "none")
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+TRACE_SAMPLE_RATIO = float(os.getenv("TRACE_SAMPLE_RATIO", "1.0"))
+
+TRACEPARENT_HEADER = "traceparent"
+
+_TRACEPARENT = re.compile(r"^([0-9a-f]{2})-([0-9a-f]{32})-([0-9a-f]{16})-([0-9a-f]{2})$")
+_INVALID_TRACE_ID = "0" * 32
+_INVALID_SPAN_ID = "0" * 16
+
+
+class SpanContext(NamedTuple):
+    """A span from another process, as carried by a ``traceparent`` header."""
+    trace_id: str
+    span_id: str
+    sampled: bool
+
+
+def extract(value: Optional[Union[str, bytes]]) -> Optional[SpanContext]:
+    """Parse a ``traceparent`` value; malformed or unsupported values start a new trace."""
+    if not value:
+        return None
+    if isinstance(value, bytes):
+        value = value.decode("latin-1")
+    match = _TRACEPARENT.match(value.strip().lower())
+    if match is None:
+        return None
+    version, trace_id, span_id, flags = match.groups()
+    if version == "ff" or trace_id == _INVALID_TRACE_ID or span_id == _INVALID_SPAN_ID:
+        return None
+    return SpanContext(trace_id, span_id, bool(int(flags, 16) & 0x01))
+
+
+def _new_id(bits: int) -> str:
+    return f"{random.getrandbits(bits) or 1:0{bits // 4}x}"
+
+
+class Span:
+    def __init__(
+        self,
+        name: str,
+        kind: str = "internal",
+        parent: Optional[Union["Span", SpanContext]] = None,
+        service: Optional[str] = None,
+        attributes: Optional[dict] = None,
+    ):
+        self.name = name
+        self.kind = kind
+        if parent is None:
+            self.trace_id = _new_id(128)
+            self.parent_id = None
+            self.sampled = random.random() < TRACE_SAMPLE_RATIO
+        else:
+            self.trace_id = parent.trace_id
+            self.parent_id = parent.span_id
+            self.sampled = parent.sampled
+        self.span_id = _new_id(64)
+        self.service = service or getattr(parent, "service", None)
+        self.attributes = dict(attributes or {})
+        self.status = "ok"
+        self.start_time = time.time()
+        self._started = time.perf_counter()
+        self.duration_ms: Optional[float] = None
+
+    @property
+    def traceparent(self) -> str:
+        return f"00-{self.trace_id}-{self.span_id}-{'01' if self.sampled else '00'}"
+
+    def end(self):
+        if self.duration_ms is None:
+            self.duration_ms = (time.perf_counter() - self._started) * 1000
+            _export(self)
+
+    def to_dict(self) -> dict:
+        return {
+            "trace_id": self.trace_id,
+            "span_id": self.span_id,
+            "parent_id": self.parent_id,
+            "name": self.name,
+            "kind": self.kind,
+            "service": self.service,
+            "start_time": self.start_time,
+            "duration_ms": round(self.duration_ms or 0.0, 3),
+            "status": self.status,
+            "attributes": self.attributes,
+        }
+
+
+# Exporters
+class SpanExporter:
+    def export(self, spans: List[dict]):
+        raise NotImplementedError
+
+    def shutdown(self):
+        pass
+
+
+class InMemoryExporter(SpanExporter):
+    """Keeps finished spans in a list, for tests and the load-test harness."""
+
+    def __init__(self):
+        self.spans: List[dict] = []
+        self._lock = threading.Lock()
+
+    def export(self, spans: List[dict]):
+        with self._lock:
+            self.spans.extend(spans)
+
+    def trace(self, trace_id: str) -> List[dict]:
+        with self._lock:
+            return [span for span in self.spans if span["trace_id"] == trace_id]
+
+    def clear(self):
+        with self._lock:
+            self.spans.clear()
+
+
+class FileExporter(SpanExporter):
+    """Appends one JSON object per span to ``path``."""
+
+    def __init__(self, path: str = TRACE_FILE):
+        self.path = path
+        self._lock = threading.Lock()
+        self._file = None
+
+    def export(self, spans: List[dict]):
+        lines = "".join(json.dumps(span, default=str) + "\n" for span in spans)
+        with self._lock:
+            if self._file is None:
+                self._file = open(self.path, "a", encoding="utf-8")
+            self._file.write(lines)
+            self._file.flush()
+
+    def shutdown(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class ConsoleExporter(SpanExporter):
+    def export(self, spans: List[dict]):
+        for span in spans:
+            print(json.dumps(span, default=str))
+
+
+def exporter_from_env(name: str = TRACE_EXPORTER) -> Optional[SpanExporter]:
+    if name == "none":
+        return None
+    if name == "memory":
+        return InMemoryExporter()
+    if name == "file":
+        return FileExporter(TRACE_FILE)
+    if name == "console":
+        return ConsoleExporter()
+    module, _, factory = name.partition(":")
+    return getattr(importlib.import_module(module), factory)()
+
+
+_exporter: Optional[SpanExporter] = exporter_from_env()
+
+
+def get_exporter() -> Optional[SpanExporter]:
+    return _exporter
+
+
+def set_exporter(exporter: Optional[SpanExporter]) -> Optional[SpanExporter]:
+    """Install ``exporter`` for the whole process; returns the previous one."""
+    global _exporter
+    previous, _exporter = _exporter, exporter
+    return previous
+
+
+def _export(span: Span):
+    exporter = _exporter
+    if exporter is None or not span.sampled:
+        return
+    try:
+        exporter.export([span.to_dict()])
+    except Exception as e:
+        print(f"Span export error (non-critical): {e}")
+
+
+# Context
+_current: ContextVar[Optional[Span]] = ContextVar("current_span", default=None)
+
+
+def current_span() -> Optional[Span]:
+    return _current.get()
+
+
+def current_traceparent() -> Optional[str]:
+    span = _current.get()
+    return span.traceparent if span is not None else None
+
+
+@contextmanager
+def span(
+    name: str,
+    kind: str = "internal",
+    parent: Optional[Union[Span, SpanContext]] = None,
+    service: Optional[str] = None,
+    attributes: Optional[dict] = None,
+) -> Iterator[Span]:
+    """Run the block in a new span, a child of ``parent`` or else of the current span."""
+    current = Span(name, kind, parent or _current.get(), service, attributes)
+    token = _current.set(current)
+    try:
+        yield current
+    except BaseException as e:
+        current.status = "error"
+        current.attributes["error"] = repr(e)
+        raise
+    finally:
+        _current.reset(token)
+        current.end()
+
+
+def record_span(name: str, kind: str, duration: float, attributes: Optional[dict] = None):
+    """Record a finished leaf span of ``duration`` seconds under the current span.
+
+    For hot paths such as SQL statements: nothing is allocated unless the
+    current trace is sampled and an exporter is installed.
+    """
+    parent = _current.get()
+    if parent is None or not parent.sampled or _exporter is None:
+        return
+    leaf = Span(name, kind, parent, attributes=attributes)
+    leaf.start_time -= duration
+    leaf.duration_ms = duration * 1000
+    _export(leaf)
+
+
+class TracingMiddleware:
+    """ASGI middleware that wraps every HTTP request in a server span."""
+
+    def __init__(self, app, service: str):
+        self.app = app
+        self.service = service
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        parent = None
+        for name, value in scope["headers"]:
+            if name == b"traceparent":
+                parent = extract(value)
+                break
+
+        status = 500
+
+        async def send_and_record_status(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        method = scope["method"]
+        with span(method, "server", parent, self.service, {"http.method": method}) as server_span:
+            try:
+                await self.app(scope, receive, send_and_record_status)
+            finally:
+                route = getattr(scope.get("route"), "path", None)
+                server_span.name = f"{method} {route or 'unmatched'}"
+                server_span.attributes["http.target"] = scope["path"]
+                server_span.attributes["http.status_code"] = status
+                if status >= 500:
+                    server_span.status = "error"
+
+
+def trace_requests(app, service: str):
+    """Trace every request ``app`` handles, continuing incoming W3C trace context."""
+    app.add_middleware(TracingMiddleware, service=service)
@@ -1,13 +1,29 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, Header, HTTPException, Request, Response
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from typing import List, Optional
+from typing import Dict, List, Optional, Set, Union
 from enum import Enum
-import sqlite3
+from collections import defaultdict
+import asyncio
 import os
-import httpx
 import json
-from datetime import datetime
+import uuid
+from datetime import datetime, timezone
+import httpx
+from common.db import Database
+from common.events import EventSubscriber, producer_factory
+from common.feed import ChangeFeed
+from common.http import ServiceClient, Upstream
+from common.idempotency import (
+    IDEMPOTENCY_KEY_HEADER, IDEMPOTENCY_SCHEMA, IdempotencyStore, TransientHTTPException, fingerprint
+)
+from common.loop import LoopLagMonitor
+from common.metrics import instrument
+from common.migrations import Migration, add_column, migrate
+from common.outbox import OUTBOX_SCHEMA, OUTBOX_TRACE_SCHEMA, OutboxRelay, write_event, write_events
+from common.pagination import NEXT_CURSOR_HEADER, decode_cursor, next_cursor
+from common.timing import SERVER_TIMING_HEADER, StageStats, StageTimer
+from common.tracing import trace_requests
 
 app = FastAPI(title="Order Service", version="1.0.0")
 
@@ -18,13 +34,57 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=[NEXT_CURSOR_HEADER],
 )
 
+# Request, database, outbound call and event metrics on /metrics
+instrument(app, "order")
+
+# Spans for every request, continuing the caller's W3C traceparent
+trace_requests(app, "order")
+
 # Configuration
 DB_PATH = os.getenv("DB_PATH", "order.db")
 CART_SERVICE_URL = os.getenv("CART_SERVICE_URL", "http://cart-service:8002")
+CATALOG_SERVICE_URL = os.getenv("CATALOG_SERVICE_URL", "http://catalog-service:8001")
 PAYMENT_SERVICE_URL = os.getenv("PAYMENT_SERVICE_URL", "http://payment-service:8004")
 KAFKA_BOOTSTRAP_SERVERS = os.getenv("KAFKA_BOOTSTRAP_SERVERS", "kafka:9092")
+CART_TIMEOUT = float(os.getenv("CART_TIMEOUT", "3.0"))
+CATALOG_TIMEOUT = float(os.getenv("CATALOG_TIMEOUT", "2.0"))
+PAYMENT_TIMEOUT = float(os.getenv("PAYMENT_TIMEOUT", "5.0"))
+MAX_STATUS_BATCH = int(os.getenv("MAX_STATUS_BATCH", "10000"))
+# Columns read for orders and their line items; IN lists are chunked at MAX_BATCH_IDS,
+# which also matches the most reservations catalog releases per call
+ORDER_COLUMNS = "id, user_id, status, total_amount, payment_id, created_at, updated_at"
+ITEM_COLUMNS = "order_id, product_id, product_name, quantity, price"
+MAX_BATCH_IDS = 500
+
+db = Database(DB_PATH)
+
+# Pooled client for calls to cart, catalog and payment, opened on startup and closed on shutdown
+http = ServiceClient(
+    Upstream("cart", CART_SERVICE_URL, timeout=CART_TIMEOUT),
+    Upstream("catalog", CATALOG_SERVICE_URL, timeout=CATALOG_TIMEOUT),
+    Upstream("payment", PAYMENT_SERVICE_URL, timeout=PAYMENT_TIMEOUT),
+)
+loop_lag = LoopLagMonitor()
+
+# Events are committed to the outbox with the order rows and relayed to Kafka in the background
+outbox_relay = OutboxRelay(db, producer_factory(KAFKA_BOOTSTRAP_SERVERS))
+
+# Dashboards follow order changes over server-sent events instead of polling;
+# the feed reads the topic so every replica streams every change
+feed = ChangeFeed()
+order_feed = EventSubscriber("order-events", KAFKA_BOOTSTRAP_SERVERS, feed.publish_event, service="order")
+
+# Retried checkouts and payments carrying an Idempotency-Key run only once
+idempotency = IdempotencyStore(db)
+
+# Running per-stage checkout latency, reported on /health
+checkout_timings = StageStats()
+
+# Strong references to fire-and-forget work so it is not garbage collected mid-flight
+background_tasks: Set[asyncio.Task] = set()
 
 class OrderStatus(str, Enum):
     PENDING = "pending"
@@ -35,10 +95,26 @@ class OrderStatus(str, Enum):
     DELIVERED = "delivered"
     CANCELLED = "cancelled"
 
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("""
+# Moves allowed by the status endpoints; delivered and cancelled are final.
+# Only the payment flow marks an order paid, so no status change leads to it.
+STATUS_TRANSITIONS = {
+    OrderStatus.PENDING: {OrderStatus.CONFIRMED, OrderStatus.CANCELLED},
+    OrderStatus.CONFIRMED: {OrderStatus.CANCELLED},
+    OrderStatus.PAID: {OrderStatus.PROCESSING, OrderStatus.CANCELLED},
+    OrderStatus.PROCESSING: {OrderStatus.SHIPPED, OrderStatus.CANCELLED},
+    OrderStatus.SHIPPED: {OrderStatus.DELIVERED},
+    OrderStatus.DELIVERED: set(),
+    OrderStatus.CANCELLED: set(),
+}
+PAYABLE_STATUSES = {OrderStatus.PENDING.value, OrderStatus.CONFIRMED.value}
+
+class OrderFields(str, Enum):
+    FULL = "full"
+    SUMMARY = "summary"
+
+# Schema migrations, applied in order at startup
+MIGRATIONS = [
+    Migration(1, "create_orders", ["""
         CREATE TABLE IF NOT EXISTS orders (
             id INTEGER PRIMARY KEY AUTOINCREMENT,
             user_id TEXT NOT NULL,
@@ -49,13 +125,112 @@ def init_db():
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
             updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
-    """)
-    conn.commit()
-    conn.close()
+    """]),
+    Migration(2, "create_outbox", OUTBOX_SCHEMA),
+    # Backs keyset pagination over (created_at, id)
+    Migration(3, "orders_created_at_index", [
+        "CREATE INDEX IF NOT EXISTS idx_orders_created_at_id ON orders(created_at, id)",
+    ]),
+    # Serves /orders/user/{user_id} ... ORDER BY created_at DESC straight from the index
+    Migration(4, "orders_user_id_index", [
+        "CREATE INDEX IF NOT EXISTS idx_orders_user_id_created_at ON orders(user_id, created_at)",
+    ]),
+    # Line items move out of the orders.items JSON blob. New orders store an empty
+    # blob; older rows are copied over lazily the first time they are read.
+    Migration(5, "create_order_items", [
+        """
+        CREATE TABLE IF NOT EXISTS order_items (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            order_id INTEGER NOT NULL REFERENCES orders(id),
+            product_id INTEGER NOT NULL,
+            product_name TEXT NOT NULL,
+            quantity INTEGER NOT NULL,
+            price REAL NOT NULL
+        )
+        """,
+        "CREATE INDEX IF NOT EXISTS idx_order_items_order_id ON order_items(order_id)",
+        "CREATE INDEX IF NOT EXISTS idx_order_items_product_id ON order_items(product_id)",
+    ]),
+    # Catalog stock reservation held by each line, released if the order is cancelled
+    Migration(6, "order_items_reservation_id", [
+        add_column("order_items", "reservation_id", "INTEGER"),
+    ]),
+    Migration(7, "create_idempotency_keys", IDEMPOTENCY_SCHEMA),
+    # Trace context of the request that wrote each event, sent on as a message header
+    Migration(8, "outbox_traceparent", OUTBOX_TRACE_SCHEMA),
+    # Serve GET /orders?status=&user_id= filters, newest first, from the index
+    Migration(9, "orders_status_indexes", [
+        "CREATE INDEX IF NOT EXISTS idx_orders_status_created_at_id ON orders(status, created_at, id)",
+        "CREATE INDEX IF NOT EXISTS idx_orders_user_id_status_created_at_id "
+        "ON orders(user_id, status, created_at, id)",
+    ]),
+    # Order count and revenue per status for /orders/stats. Triggers keep it
+    # current in the same transaction as every insert and status change, so
+    # checkout, status updates and payment never scan orders to maintain it.
+    Migration(10, "create_order_stats", [
+        """
+        CREATE TABLE IF NOT EXISTS order_stats (
+            status TEXT PRIMARY KEY,
+            order_count INTEGER NOT NULL DEFAULT 0,
+            revenue REAL NOT NULL DEFAULT 0
+        )
+        """,
+        """
+        INSERT OR REPLACE INTO order_stats (status, order_count, revenue)
+        SELECT status, COUNT(*), TOTAL(total_amount) FROM orders GROUP BY status
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS order_stats_insert AFTER INSERT ON orders
+        BEGIN
+            INSERT INTO order_stats (status, order_count, revenue) VALUES (NEW.status, 1, NEW.total_amount)
+            ON CONFLICT(status) DO UPDATE SET
+                order_count = order_count + 1, revenue = revenue + excluded.revenue;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS order_stats_update AFTER UPDATE OF status, total_amount ON orders
+        WHEN OLD.status IS NOT NEW.status OR OLD.total_amount IS NOT NEW.total_amount
+        BEGIN
+            UPDATE order_stats SET order_count = order_count - 1, revenue = revenue - OLD.total_amount
+            WHERE status = OLD.status;
+            INSERT INTO order_stats (status, order_count, revenue) VALUES (NEW.status, 1, NEW.total_amount)
+            ON CONFLICT(status) DO UPDATE SET
+                order_count = order_count + 1, revenue = revenue + excluded.revenue;
+        END
+        """,
+        """
+        CREATE TRIGGER IF NOT EXISTS order_stats_delete AFTER DELETE ON orders
+        BEGIN
+            UPDATE order_stats SET order_count = order_count - 1, revenue = revenue - OLD.total_amount
+            WHERE status = OLD.status;
+        END
+        """,
+    ]),
+]
+
+def init_db():
+    migrate(db, MIGRATIONS)
 
 @app.on_event("startup")
-def startup():
+async def startup():
     init_db()
+    await http.start()
+    await outbox_relay.start()
+    await idempotency.start()
+    await order_feed.start()
+    loop_lag.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await loop_lag.stop()
+    # Let in-flight cart clears finish before the HTTP client goes away
+    if background_tasks:
+        await asyncio.gather(*background_tasks, return_exceptions=True)
+    await order_feed.stop()
+    await idempotency.stop()
+    await outbox_relay.stop()
+    await http.close()
+    db.close()
 
 # Models
 class OrderItem(BaseModel):
@@ -67,12 +242,11 @@ class OrderItem(BaseModel):
 class OrderCreate(BaseModel):
     user_id: str
 
-class Order(BaseModel):
+class OrderSummary(BaseModel):
     id: int
     user_id: str
     status: str
     total_amount: float
-    items: List[OrderItem]
     payment_id: Optional[str]
     created_at: str
     updated_at: str
@@ -80,40 +254,351 @@ class Order(BaseModel):
     class Config:
         from_attributes = True
 
-# Helper function to publish to Kafka
-async def publish_order_event(event_type: str, order_data: dict):
+class Order(OrderSummary):
+    items: List[OrderItem]
+
+class StatusChange(BaseModel):
+    order_id: int
+    status: OrderStatus
+
+class StatusBatch(BaseModel):
+    updates: List[StatusChange]
+
+class StatusChangeResult(BaseModel):
+    order_id: int
+    result: str
+    previous_status: Optional[str] = None
+    status: Optional[str] = None
+    detail: Optional[str] = None
+
+class StatusBatchResult(BaseModel):
+    updated: int
+    failed: int
+    results: List[StatusChangeResult]
+
+class StatusStats(BaseModel):
+    status: str
+    count: int
+    revenue: float
+
+class OrderStats(BaseModel):
+    total_count: int
+    total_revenue: float
+    statuses: List[StatusStats]
+
+# Helper functions to stage Kafka events in the caller's transaction
+def order_event(event_type: str, order_data: dict) -> dict:
+    return {
+        "event_type": event_type,
+        "timestamp": datetime.utcnow().isoformat(),
+        "data": order_data
+    }
+
+def record_order_event(conn, event_type: str, order_data: dict):
+    write_event(conn, "order-events", order_event(event_type, order_data), key=str(order_data["order_id"]))
+
+def insert_order(conn, user_id: str, total_amount: float, items: list) -> dict:
+    """Insert the order and its items; returns the full order without reading it back."""
+    order = dict(conn.execute(
+        "INSERT INTO orders (user_id, status, total_amount, items) VALUES (?, ?, ?, '') "
+        f"RETURNING {ORDER_COLUMNS}",
+        (user_id, OrderStatus.PENDING.value, total_amount)
+    ).fetchone())
+    order_id = order["id"]
+    conn.executemany(
+        "INSERT INTO order_items (order_id, product_id, product_name, quantity, price, reservation_id) "
+        "VALUES (?, ?, ?, ?, ?, ?)",
+        [
+            (order_id, item["product_id"], item["product_name"], item["quantity"], item["price"],
+             item.get("reservation_id"))
+            for item in items
+        ]
+    )
+    order["items"] = items
+    record_order_event(conn, "order_created", {
+        "order_id": order_id,
+        "user_id": user_id,
+        "total_amount": total_amount,
+        # The whole order, so subscribers can show it without a read
+        "changes": Order.model_validate(order).model_dump()
+    })
+    conn.commit()
+    return order
+
+def apply_status_changes(conn, changes: List[StatusChange]) -> tuple:
+    """Validate and apply a batch of status changes in one transaction.
+
+    Changes apply in request order, so one batch may move an order through
+    several states. Returns the per-change results and the stock reservations
+    of orders the batch cancelled.
+    """
+    # Take the write lock first so no other writer moves an order between validation and update
+    conn.execute("BEGIN IMMEDIATE")
+    order_ids = list(dict.fromkeys(change.order_id for change in changes))
+    current: Dict[int, str] = {}
+    for start in range(0, len(order_ids), MAX_BATCH_IDS):
+        chunk = order_ids[start:start + MAX_BATCH_IDS]
+        placeholders = ", ".join("?" for _ in chunk)
+        for row in conn.execute(f"SELECT id, status FROM orders WHERE id IN ({placeholders})", chunk):
+            current[row["id"]] = row["status"]
+
+    # Stored like CURRENT_TIMESTAMP, so every row and event in the batch carries the same time
+    updated_at = datetime.utcnow().strftime("%Y-%m-%d %H:%M:%S")
+    results = []
+    events = []
+    final: Dict[int, str] = {}
+    for change in changes:
+        previous = current.get(change.order_id)
+        result = {"order_id": change.order_id, "previous_status": previous, "status": previous}
+        if previous is None:
+            result.update(result="not_found", detail="Order not found")
+        elif previous == change.status.value:
+            result["result"] = "unchanged"
+        elif change.status not in STATUS_TRANSITIONS[OrderStatus(previous)]:
+            result.update(
+                result="invalid_transition",
+                detail=f"Cannot move order from {previous} to {change.status.value}"
+            )
+        else:
+            current[change.order_id] = final[change.order_id] = change.status.value
+            result.update(result="updated", status=change.status.value)
+            events.append((order_event("order_status_updated", {
+                "order_id": change.order_id,
+                "status": change.status.value,
+                "changes": {"status": change.status.value, "updated_at": updated_at}
+            }), str(change.order_id)))
+        results.append(result)
+
+    conn.executemany(
+        "UPDATE orders SET status = ?, updated_at = ? WHERE id = ?",
+        [(status, updated_at, order_id) for order_id, status in final.items()]
+    )
+    write_events(conn, "order-events", events)
+
+    cancelled = [order_id for order_id, status in final.items() if status == OrderStatus.CANCELLED.value]
+    reservation_ids = []
+    for start in range(0, len(cancelled), MAX_BATCH_IDS):
+        chunk = cancelled[start:start + MAX_BATCH_IDS]
+        placeholders = ", ".join("?" for _ in chunk)
+        reservation_ids.extend(row["reservation_id"] for row in conn.execute(
+            f"SELECT reservation_id FROM order_items WHERE order_id IN ({placeholders}) "
+            "AND reservation_id IS NOT NULL",
+            chunk
+        ))
+    conn.commit()
+    return results, reservation_ids
+
+def mark_order_paid(conn, order_id: int, payment_id: Optional[str]) -> bool:
+    """Mark the order paid unless it left the payable statuses while the payment ran."""
+    placeholders = ", ".join("?" for _ in PAYABLE_STATUSES)
+    updated = conn.execute(
+        "UPDATE orders SET payment_id = ?, status = ?, updated_at = CURRENT_TIMESTAMP "
+        f"WHERE id = ? AND status IN ({placeholders}) "
+        "RETURNING status, payment_id, updated_at",
+        (payment_id, OrderStatus.PAID.value, order_id, *sorted(PAYABLE_STATUSES))
+    ).fetchone()
+    if updated is None:
+        return False
+    record_order_event(conn, "order_paid", {
+        "order_id": order_id,
+        "payment_id": payment_id,
+        "changes": dict(updated)
+    })
+    conn.commit()
+    return True
+
+# Order loading: orders come back as plain dicts so FastAPI validates each row once
+
+def migrate_legacy_items(conn, legacy: Dict[int, str]):
+    """Copy JSON line items of pre-order_items orders into order_items, once."""
+    for order_id, blob in legacy.items():
+        # Clearing the blob first claims the row, so concurrent readers cannot copy it twice
+        claimed = conn.execute("UPDATE orders SET items = '' WHERE id = ? AND items != ''", (order_id,))
+        if claimed.rowcount == 0:
+            continue
+        conn.executemany(
+            f"INSERT INTO order_items ({ITEM_COLUMNS}) VALUES (?, ?, ?, ?, ?)",
+            [
+                (order_id, item["product_id"], item["product_name"], item["quantity"], item["price"])
+                for item in json.loads(blob)
+            ]
+        )
+
+def load_orders(conn, clause: str, params: tuple, fields: OrderFields = OrderFields.FULL) -> List[dict]:
+    if fields == OrderFields.SUMMARY:
+        rows = conn.execute(f"SELECT {ORDER_COLUMNS} FROM orders {clause}", params).fetchall()
+        return [dict(row) for row in rows]
+
+    rows = conn.execute(
+        f"SELECT {ORDER_COLUMNS}, NULLIF(items, '') AS legacy_items FROM orders {clause}", params
+    ).fetchall()
+    orders = []
+    legacy = {}
+    for row in rows:
+        order = dict(row)
+        blob = order.pop("legacy_items")
+        if blob:
+            legacy[order["id"]] = blob
+        orders.append(order)
+    if legacy:
+        migrate_legacy_items(conn, legacy)
+
+    # One query per page for every order's line items
+    items_by_order = defaultdict(list)
+    order_ids = [order["id"] for order in orders]
+    for start in range(0, len(order_ids), MAX_BATCH_IDS):
+        chunk = order_ids[start:start + MAX_BATCH_IDS]
+        placeholders = ", ".join("?" for _ in chunk)
+        for item in conn.execute(
+            f"SELECT {ITEM_COLUMNS} FROM order_items WHERE order_id IN ({placeholders}) ORDER BY id", chunk
+        ):
+            item = dict(item)
+            items_by_order[item.pop("order_id")].append(item)
+    for order in orders:
+        order["items"] = items_by_order[order["id"]]
+    return orders
+
+def load_order_stats(conn) -> dict:
+    counts = {
+        row["status"]: row
+        for row in conn.execute("SELECT status, order_count, revenue FROM order_stats")
+    }
+    # Every status is listed, in lifecycle order, including those with no orders yet
+    statuses = [status.value for status in OrderStatus]
+    statuses += sorted(set(counts) - set(statuses))
+    stats = []
+    for status in statuses:
+        row = counts.get(status)
+        stats.append({
+            "status": status,
+            "count": row["order_count"] if row else 0,
+            "revenue": round(row["revenue"], 2) if row else 0.0,
+        })
+    return {
+        "total_count": sum(entry["count"] for entry in stats),
+        "total_revenue": round(sum(entry["revenue"] for entry in stats), 2),
+        "statuses": stats,
+    }
+
+# Helper functions for catalog stock reservations
+async def reserve_stock(items: list) -> List[int]:
+    """Reserve every line in one all-or-nothing catalog call; returns reservation IDs in line order.
+
+    The call carries a fresh reservation key. If the response is lost after
+    catalog committed, the reservation is released by that key instead of leaking.
+    """
+    reservation_key = str(uuid.uuid4())
+    try:
+        response = await http.post(
+            "catalog",
+            "/products/reserve",
+            json={
+                "reservation_key": reservation_key,
+                "items": [{"product_id": item["product_id"], "quantity": item["quantity"]} for item in items]
+            }
+        )
+    except httpx.HTTPError as e:
+        print(f"Error reserving stock: {e}")
+        await release_reservation_key(reservation_key)
+        raise HTTPException(status_code=502, detail="Stock reservation failed")
+    if response.status_code != 200:
+        if response.status_code >= 500:
+            # A gateway error may hide a reservation that did commit
+            await release_reservation_key(reservation_key)
+        try:
+            detail = response.json().get("detail", "Stock reservation failed")
+        except Exception:
+            detail = "Stock reservation failed"
+        raise HTTPException(status_code=409 if response.status_code in (404, 409) else 502, detail=detail)
+    return [reservation["reservation_id"] for reservation in response.json()["reservations"]]
+
+async def release_stock(reservation_ids: List[int]):
+    # Catalog takes at most MAX_BATCH_IDS reservations per call
+    for start in range(0, len(reservation_ids), MAX_BATCH_IDS):
+        chunk = reservation_ids[start:start + MAX_BATCH_IDS]
+        try:
+            await http.post("catalog", "/products/release", json={"reservation_ids": chunk})
+        except Exception as e:
+            print(f"Error releasing stock reservations {chunk}: {e}")
+
+async def release_reservation_key(reservation_key: str):
+    try:
+        await http.post("catalog", "/products/release", json={"reservation_keys": [reservation_key]})
+    except Exception as e:
+        print(f"Error releasing stock reservation {reservation_key}: {e}")
+
+async def refund_payment(payment_id: Optional[str]):
+    if payment_id is None:
+        return
     try:
-        from kafka import KafkaProducer
-        producer = KafkaProducer(
-            bootstrap_servers=KAFKA_BOOTSTRAP_SERVERS,
-            value_serializer=lambda v: json.dumps(v).encode('utf-8')
+        # Refunds are idempotent, so the key lets the client retry this one
+        response = await http.post(
+            "payment", f"/payments/{payment_id}/refund", headers={IDEMPOTENCY_KEY_HEADER: f"refund-{payment_id}"}
         )
-        event = {
-            "event_type": event_type,
-            "timestamp": datetime.utcnow().isoformat(),
-            "data": order_data
-        }
-        producer.send("order-events", value=event)
-        producer.flush()
+        if response.status_code != 200:
+            print(f"Error refunding payment {payment_id}: payment service returned {response.status_code}")
     except Exception as e:
-        print(f"Kafka publish error (non-critical): {e}")
+        print(f"Error refunding payment {payment_id}: {e}")
+
+def run_in_background(coro):
+    task = asyncio.create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+async def clear_cart(user_id: str):
+    timer = StageTimer(checkout_timings)
+    with timer.span("cart_clear"):
+        try:
+            await http.delete("cart", f"/cart/{user_id}")
+        except Exception as e:
+            print(f"Error clearing cart for {user_id}: {e}")
 
 # Routes
 @app.get("/health")
 def health():
-    return {"status": "healthy", "service": "order"}
+    return {
+        "status": "healthy",
+        "service": "order",
+        **loop_lag.snapshot(),
+        "outbox": outbox_relay.stats(),
+        "checkout": checkout_timings.snapshot(),
+        "idempotency": idempotency.stats(),
+        "feed": feed.stats(),
+    }
 
 @app.post("/orders", response_model=Order)
-async def create_order(order_data: OrderCreate):
+async def create_order(
+    order_data: OrderCreate,
+    response: Response,
+    idempotency_key: Optional[str] = Header(None),
+):
+    return await idempotency.execute(
+        "create_order",
+        idempotency_key,
+        fingerprint(order_data.model_dump()),
+        lambda: place_order(order_data, response),
+        response_model=Order,
+        response=response,
+    )
+
+async def place_order(order_data: OrderCreate, response: Response) -> dict:
+    timer = StageTimer(checkout_timings)
+    
     # Get cart items
-    async with httpx.AsyncClient() as client:
-        cart_response = await client.get(f"{CART_SERVICE_URL}/cart/{order_data.user_id}")
-        if cart_response.status_code != 200:
-            raise HTTPException(status_code=404, detail="Cart not found")
-        
-        cart = cart_response.json()
-        if not cart.get("items"):
-            raise HTTPException(status_code=400, detail="Cart is empty")
+    with timer.span("cart_fetch"):
+        cart_response = await http.get("cart", f"/cart/{order_data.user_id}")
+    if cart_response.status_code != 200:
+        raise HTTPException(status_code=404, detail="Cart not found")
+    
+    cart = cart_response.json()
+    if not cart.get("items"):
+        # Not stored with the Idempotency-Key, so a retry runs again once the cart is filled
+        raise TransientHTTPException(status_code=400, detail="Cart is empty")
+    
+    # Lines catalog no longer returns come back unpriced and cannot be ordered
+    unpriced = [str(item["product_id"]) for item in cart["items"] if item.get("product_price") is None]
+    if unpriced:
+        raise HTTPException(status_code=409, detail=f"Products no longer available: {', '.join(unpriced)}")
     
     # Create order
     items = []
@@ -125,141 +610,178 @@ async def create_order(order_data: OrderCreate):
             "price": item.get("product_price", 0)
         })
     
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        "INSERT INTO orders (user_id, status, total_amount, items) VALUES (?, ?, ?, ?)",
-        (order_data.user_id, OrderStatus.PENDING.value, cart["total"], json.dumps(items))
-    )
-    order_id = cursor.lastrowid
-    conn.commit()
-    conn.close()
+    # Take the stock first so concurrent checkouts cannot oversell
+    with timer.span("stock_reserve"):
+        reservation_ids = await reserve_stock(items)
+    for item, reservation_id in zip(items, reservation_ids):
+        item["reservation_id"] = reservation_id
     
-    # Clear cart
-    async with httpx.AsyncClient() as client:
-        await client.delete(f"{CART_SERVICE_URL}/cart/{order_data.user_id}")
+    # The order row and its order_created event commit together; the outbox
+    # relay publishes the event in the background
+    with timer.span("order_insert"):
+        try:
+            order = await db.run(insert_order, order_data.user_id, cart["total"], items)
+        except Exception:
+            await release_stock(reservation_ids)
+            raise
+    outbox_relay.notify()
     
-    # Get created order
-    order = await get_order(order_id)
-    
-    # Publish order created event
-    await publish_order_event("order_created", {
-        "order_id": order_id,
-        "user_id": order_data.user_id,
-        "total_amount": cart["total"]
-    })
+    # The order is committed, so clearing the cart does not hold up the response
+    run_in_background(clear_cart(order_data.user_id))
     
+    response.headers[SERVER_TIMING_HEADER] = timer.header()
     return order
 
+@app.get("/orders/stream")
+async def stream_orders(request: Request, last_event_id: Optional[str] = Header(None)):
+    """Server-sent events: order_created, order_status_updated, order_paid."""
+    return feed.response(request, last_event_id)
+
+@app.get("/orders/stats", response_model=OrderStats)
+async def get_order_stats():
+    """Order count and revenue per status, read from the order_stats summary table."""
+    return await db.run(load_order_stats)
+
 @app.get("/orders/{order_id}", response_model=Order)
 async def get_order(order_id: int):
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM orders WHERE id = ?", (order_id,))
-    row = cursor.fetchone()
-    conn.close()
+    orders = await db.run(load_orders, "WHERE id = ?", (order_id,))
     
-    if not row:
+    if not orders:
         raise HTTPException(status_code=404, detail="Order not found")
     
-    order_dict = dict(row)
-    order_dict["items"] = json.loads(order_dict["items"])
-    return Order(**order_dict)
-
-@app.get("/orders/user/{user_id}", response_model=List[Order])
-async def get_user_orders(user_id: str):
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM orders WHERE user_id = ? ORDER BY created_at DESC", (user_id,))
-    rows = cursor.fetchall()
-    conn.close()
-    
-    orders = []
-    for row in rows:
-        order_dict = dict(row)
-        order_dict["items"] = json.loads(order_dict["items"])
-        orders.append(Order(**order_dict))
-    
-    return orders
+    return orders[0]
+
+@app.get("/orders/user/{user_id}", response_model=Union[List[Order], List[OrderSummary]])
+async def get_user_orders(user_id: str, fields: OrderFields = OrderFields.FULL):
+    return await db.run(
+        load_orders, "WHERE user_id = ? ORDER BY created_at DESC", (user_id,), fields
+    )
 
 @app.put("/orders/{order_id}/status")
 async def update_order_status(order_id: int, status: OrderStatus):
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        "UPDATE orders SET status = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
-        (status.value, order_id)
+    # A batch of one, so single and batch updates follow the same transition rules
+    results, reservation_ids = await db.run(
+        apply_status_changes, [StatusChange(order_id=order_id, status=status)]
     )
-    if cursor.rowcount == 0:
-        conn.close()
-        raise HTTPException(status_code=404, detail="Order not found")
-    conn.commit()
-    conn.close()
+    result = results[0]
+    if result["result"] == "not_found":
+        raise HTTPException(status_code=404, detail=result["detail"])
+    if result["result"] == "invalid_transition":
+        raise HTTPException(status_code=409, detail=result["detail"])
+    outbox_relay.notify()
+    await release_stock(reservation_ids)
     
-    order = await get_order(order_id)
+    return await get_order(order_id)
+
+@app.post("/orders/status:batch", response_model=StatusBatchResult, response_model_exclude_none=True)
+async def update_order_statuses(batch: StatusBatch):
+    """Apply many status changes at once; each change gets its own result."""
+    if not batch.updates:
+        raise HTTPException(status_code=400, detail="No updates given")
+    if len(batch.updates) > MAX_STATUS_BATCH:
+        raise HTTPException(status_code=400, detail=f"At most {MAX_STATUS_BATCH} updates per batch")
     
-    # Publish status update event
-    await publish_order_event("order_status_updated", {
-        "order_id": order_id,
-        "status": status.value
-    })
+    results, reservation_ids = await db.run(apply_status_changes, batch.updates)
+    # One wakeup; the relay publishes the staged events in batches
+    outbox_relay.notify()
+    await release_stock(reservation_ids)
     
-    return order
+    updated = sum(1 for result in results if result["result"] == "updated")
+    failed = sum(1 for result in results if result["result"] in ("not_found", "invalid_transition"))
+    return {"updated": updated, "failed": failed, "results": results}
 
 @app.post("/orders/{order_id}/payment")
-async def process_payment(order_id: int):
+async def process_payment(order_id: int, idempotency_key: Optional[str] = Header(None)):
+    return await idempotency.execute(
+        "process_payment",
+        idempotency_key,
+        fingerprint(order_id),
+        lambda: pay_order(order_id, idempotency_key),
+    )
+
+async def pay_order(order_id: int, idempotency_key: Optional[str]) -> dict:
     order = await get_order(order_id)
     
-    if order.status != OrderStatus.PENDING.value:
-        raise HTTPException(status_code=400, detail="Order is not in pending status")
+    if order["status"] not in PAYABLE_STATUSES:
+        raise HTTPException(status_code=400, detail="Order is not awaiting payment")
     
-    # Call payment service
-    async with httpx.AsyncClient() as client:
-        payment_response = await client.post(
-            f"{PAYMENT_SERVICE_URL}/payments",
-            json={"order_id": order_id, "amount": order.total_amount}
+    # Call payment service; passing a key on lets the client's retries reach it safely
+    headers = {IDEMPOTENCY_KEY_HEADER: f"order-{order_id}:{idempotency_key}"} if idempotency_key else None
+    try:
+        payment_response = await http.post(
+            "payment",
+            "/payments",
+            json={"order_id": order_id, "amount": order["total_amount"]},
+            headers=headers
         )
-        if payment_response.status_code != 200:
-            raise HTTPException(status_code=400, detail="Payment failed")
-        
-        payment_data = payment_response.json()
-    
-    # Update order with payment ID and status
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        "UPDATE orders SET payment_id = ?, status = ?, updated_at = CURRENT_TIMESTAMP WHERE id = ?",
-        (payment_data.get("payment_id"), OrderStatus.PAID.value, order_id)
-    )
-    conn.commit()
-    conn.close()
+    except httpx.HTTPError as e:
+        print(f"Error calling payment service for order {order_id}: {e}")
+        raise HTTPException(status_code=502, detail="Payment service unavailable")
+    # Only a rejection from the payment service itself is final; an outage or a
+    # payment still in progress must not be replayed to the client's retries
+    if payment_response.status_code >= 500:
+        raise HTTPException(status_code=502, detail="Payment service unavailable")
+    if payment_response.status_code == 409:
+        raise HTTPException(status_code=409, detail="Payment is still in progress")
+    if payment_response.status_code != 200:
+        raise HTTPException(status_code=400, detail="Payment failed")
     
-    updated_order = await get_order(order_id)
+    payment_data = payment_response.json()
     
-    # Publish payment event
-    await publish_order_event("order_paid", {
-        "order_id": order_id,
-        "payment_id": payment_data.get("payment_id")
-    })
+    # Update order with payment ID and status
+    if not await db.run(mark_order_paid, order_id, payment_data.get("id")):
+        # Cancelled while the payment ran, and its stock is already released: give the money back
+        await refund_payment(payment_data.get("id"))
+        raise HTTPException(status_code=409, detail="Order is no longer awaiting payment")
+    outbox_relay.notify()
     
-    return updated_order
-
-@app.get("/orders", response_model=List[Order])
-async def get_all_orders(skip: int = 0, limit: int = 100):
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM orders ORDER BY created_at DESC LIMIT ? OFFSET ?", (limit, skip))
-    rows = cursor.fetchall()
-    conn.close()
+    return await get_order(order_id)
+
+@app.get("/orders", response_model=Union[List[Order], List[OrderSummary]])
+async def get_all_orders(
+    response: Response,
+    skip: int = 0,
+    limit: int = 100,
+    after: Optional[str] = None,
+    fields: OrderFields = OrderFields.FULL,
+    status: Optional[OrderStatus] = None,
+    user_id: Optional[str] = None,
+    since: Optional[datetime] = None,
+):
+    # Equality filters lead and created_at follows, matching the composite indexes
+    conditions = []
+    params = []
+    if user_id is not None:
+        conditions.append("user_id = ?")
+        params.append(user_id)
+    if status is not None:
+        conditions.append("status = ?")
+        params.append(status.value)
+    if since is not None:
+        if since.tzinfo is not None:
+            since = since.astimezone(timezone.utc).replace(tzinfo=None)
+        # created_at is stored as UTC 'YYYY-MM-DD HH:MM:SS', which compares as text
+        conditions.append("created_at >= ?")
+        params.append(since.strftime("%Y-%m-%d %H:%M:%S"))
+    if after is not None:
+        # Keyset pagination: seek past the cursor instead of scanning skipped rows
+        try:
+            created_at, order_id = decode_cursor(after)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        conditions.append("(created_at, id) < (?, ?)")
+        params.extend((created_at, order_id))
     
-    orders = []
-    for row in rows:
-        order_dict = dict(row)
-        order_dict["items"] = json.loads(order_dict["items"])
-        orders.append(Order(**order_dict))
+    clause = f"WHERE {' AND '.join(conditions)} " if conditions else ""
+    clause += "ORDER BY created_at DESC, id DESC LIMIT ?"
+    params.append(limit)
+    if after is None:
+        clause += " OFFSET ?"
+        params.append(skip)
+    orders = await db.run(load_orders, clause, tuple(params), fields)
+    cursor = next_cursor(orders, limit)
+    if cursor:
+        response.headers[NEXT_CURSOR_HEADER] = cursor
     
     return orders
 
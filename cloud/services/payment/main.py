@@ -1,12 +1,16 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, Header, HTTPException
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
 from typing import Optional
 from enum import Enum
-import sqlite3
 import os
 import uuid
 from datetime import datetime
+from common.db import Database
+from common.idempotency import IDEMPOTENCY_SCHEMA, IdempotencyStore, fingerprint
+from common.metrics import instrument
+from common.migrations import Migration, migrate
+from common.tracing import trace_requests
 
 app = FastAPI(title="Payment Service", version="1.0.0")
 
@@ -19,18 +23,28 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Request, database, outbound call and event metrics on /metrics
+instrument(app, "payment")
+
+# Spans for every request, continuing the caller's W3C traceparent
+trace_requests(app, "payment")
+
 # Configuration
 DB_PATH = os.getenv("DB_PATH", "payment.db")
+db = Database(DB_PATH)
+
+# Retried payment requests carrying an Idempotency-Key charge only once
+idempotency = IdempotencyStore(db)
 
 class PaymentStatus(str, Enum):
     PENDING = "pending"
     SUCCESS = "success"
     FAILED = "failed"
+    REFUNDED = "refunded"
 
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute("""
+# Schema migrations, applied in order at startup
+MIGRATIONS = [
+    Migration(1, "create_payments", ["""
         CREATE TABLE IF NOT EXISTS payments (
             id TEXT PRIMARY KEY,
             order_id INTEGER NOT NULL,
@@ -38,13 +52,26 @@ def init_db():
             status TEXT NOT NULL DEFAULT 'pending',
             created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
         )
-    """)
-    conn.commit()
-    conn.close()
+    """]),
+    # Serves /payments/order/{order_id} ... ORDER BY created_at DESC LIMIT 1 from the index
+    Migration(2, "payments_order_id_index", [
+        "CREATE INDEX IF NOT EXISTS idx_payments_order_id_created_at ON payments(order_id, created_at)",
+    ]),
+    Migration(3, "create_idempotency_keys", IDEMPOTENCY_SCHEMA),
+]
+
+def init_db():
+    migrate(db, MIGRATIONS)
 
 @app.on_event("startup")
-def startup():
+async def startup():
     init_db()
+    await idempotency.start()
+
+@app.on_event("shutdown")
+async def shutdown():
+    await idempotency.stop()
+    db.close()
 
 # Models
 class PaymentRequest(BaseModel):
@@ -64,10 +91,19 @@ class Payment(BaseModel):
 # Routes
 @app.get("/health")
 def health():
-    return {"status": "healthy", "service": "payment"}
+    return {"status": "healthy", "service": "payment", "idempotency": idempotency.stats()}
 
 @app.post("/payments", response_model=Payment)
-def create_payment(payment_request: PaymentRequest):
+async def create_payment(payment_request: PaymentRequest, idempotency_key: Optional[str] = Header(None)):
+    return await idempotency.execute(
+        "create_payment",
+        idempotency_key,
+        fingerprint(payment_request.model_dump()),
+        lambda: db.run(charge, payment_request),
+        response_model=Payment,
+    )
+
+def charge(conn, payment_request: PaymentRequest) -> dict:
     # Generate fake payment ID
     payment_id = str(uuid.uuid4())
     
@@ -76,25 +112,35 @@ def create_payment(payment_request: PaymentRequest):
     import random
     status = PaymentStatus.SUCCESS if random.random() > 0.1 else PaymentStatus.FAILED  # 90% success rate
     
-    conn = sqlite3.connect(DB_PATH)
-    cursor = conn.cursor()
-    cursor.execute(
-        "INSERT INTO payments (id, order_id, amount, status) VALUES (?, ?, ?, ?)",
+    payment = conn.execute(
+        "INSERT INTO payments (id, order_id, amount, status) VALUES (?, ?, ?, ?) RETURNING *",
         (payment_id, payment_request.order_id, payment_request.amount, status)
-    )
+    ).fetchone()
     conn.commit()
-    conn.close()
     
-    return get_payment(payment_id)
+    return dict(payment)
+
+@app.post("/payments/{payment_id}/refund", response_model=Payment)
+def refund_payment(payment_id: str):
+    """Refund a successful payment. Refunding it again returns it unchanged, so retries are safe."""
+    with db.connection() as conn:
+        conn.execute(
+            "UPDATE payments SET status = ? WHERE id = ? AND status = ?",
+            (PaymentStatus.REFUNDED, payment_id, PaymentStatus.SUCCESS)
+        )
+        payment = conn.execute("SELECT * FROM payments WHERE id = ?", (payment_id,)).fetchone()
+    
+    if not payment:
+        raise HTTPException(status_code=404, detail="Payment not found")
+    
+    return dict(payment)
 
 @app.get("/payments/{payment_id}", response_model=Payment)
 def get_payment(payment_id: str):
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM payments WHERE id = ?", (payment_id,))
-    payment = cursor.fetchone()
-    conn.close()
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM payments WHERE id = ?", (payment_id,))
+        payment = cursor.fetchone()
     
     if not payment:
         raise HTTPException(status_code=404, detail="Payment not found")
@@ -103,12 +149,10 @@ def get_payment(payment_id: str):
 
 @app.get("/payments/order/{order_id}", response_model=Payment)
 def get_payment_by_order(order_id: int):
-    conn = sqlite3.connect(DB_PATH)
-    conn.row_factory = sqlite3.Row
-    cursor = conn.cursor()
-    cursor.execute("SELECT * FROM payments WHERE order_id = ? ORDER BY created_at DESC LIMIT 1", (order_id,))
-    payment = cursor.fetchone()
-    conn.close()
+    with db.connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT * FROM payments WHERE order_id = ? ORDER BY created_at DESC LIMIT 1", (order_id,))
+        payment = cursor.fetchone()
     
     if not payment:
         raise HTTPException(status_code=404, detail="Payment not found")